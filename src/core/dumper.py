@@ -13,28 +13,519 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import bz2
+import hashlib
+import io
 import lzma
+import os
+import shutil
 import struct
 import sys
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from multiprocessing import cpu_count
 
 import zstandard
 
+from . import lpmake
 from . import update_metadata_pb2 as um
+from .http_file import HttpFile
+from .lpunpack import LpPartitionFile
+from .payload_index import OpDescriptor, load_index, read_index, zip_member_offset
+from .sparse_img import SparseWriter
 
 flatten = lambda l: [item for sublist in l for item in sublist]
 
-u32 = lambda x:struct.unpack(">I", x)[0]
-u64 = lambda x:struct.unpack(">Q", x)[0]
+Op = um.InstallOperation
+_process_context = {}
+# Remote payloads: ranges closer than REMOTE_GAP are fetched together, up to REMOTE_SPAN bytes per request.
+REMOTE_GAP = 262144
+REMOTE_SPAN = 33554432
+# Operation data is written to the images in buffers of this size.
+WRITE_BUFFER = 1048576
+ZSTD_MAGIC = b'(\xb5/\xfd'
+# REPLACE_ZSTD operations up to this size are decompressed in one call, their frames in parallel.
+ZSTD_WHOLE_OP = 67108864
+_zstd_local = threading.local()
+_frame_pool = None
+_frame_pool_lock = threading.Lock()
+# Operations being applied in this process, frames of an operation only spread to the CPUs the others leave idle.
+_busy_ops = 0
+_busy_lock = threading.Lock()
+# Worker processes of the process backend already fill every CPU, they decompress frames in their own thread.
+_parallel_frames = True
+
+
+class SpanReader(io.BytesIO):
+    """
+    A fetched range of a remote payload, addressed with payload offsets.
+    """
+
+    def __init__(self, data, start):
+        super().__init__(data)
+        self.start = start
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            offset -= self.start
+        return super().seek(offset, whence) + self.start
+
+    def tell(self):
+        return super().tell() + self.start
+
+
+def coalesce_ranges(ops, gap=REMOTE_GAP, span=REMOTE_SPAN):
+    """
+    Group operations into spans of payload data that can be fetched with one range request.
+    :param ops: list of (OpDescriptor, tag)
+    :return: list of (start, length, [(OpDescriptor, tag), ...])
+    """
+    spans = []
+    for op, tag in sorted(ops, key=lambda x: x[0].data_offset):
+        end = op.data_offset + op.data_length
+        if spans:
+            start, length, members = spans[-1]
+            if op.data_offset - (start + length) <= gap and end - start <= span:
+                spans[-1] = (start, max(length, end - start), members + [(op, tag)])
+                continue
+        spans.append((op.data_offset, op.data_length, [(op, tag)]))
+    return spans
+
+
+class PartitionHasher:
+    """
+    Compute the SHA-256 of a partition image from its extent writes.
+    Writes may arrive in any order, the ones ahead of the hashed position are kept until the gap is filled.
+    Ranges no operation writes to are hashed as zeros.
+    :param source: the raw image being written, a path or a callable returning it opened for reading.
+                   Once more than PENDING_LIMIT bytes wait for a gap, they are dropped and the image is hashed
+                   from source when it is complete instead
+    """
+    PENDING_LIMIT = 67108864
+
+    def __init__(self, size, extents, source=None):
+        self.sha256 = hashlib.sha256()
+        self.size = size
+        self.pos = 0
+        self.pending = {}
+        self.pending_bytes = 0
+        self.source = source
+        self.spilled = False
+        self.lock = threading.Lock()
+        self.gaps = {}
+        pos = 0
+        for offset, length in sorted(extents):
+            if offset > pos:
+                self.gaps[pos] = offset - pos
+            pos = max(pos, offset + length)
+        if pos < size:
+            self.gaps[pos] = size - pos
+
+    def update(self, offset, data):
+        with self.lock:
+            if self.spilled:
+                return
+            if offset != self.pos:
+                if self.source and self.pending_bytes + len(data) > PartitionHasher.PENDING_LIMIT:
+                    self.spilled = True
+                    self.pending.clear()
+                    return
+                self.pending[offset] = bytes(data)
+                self.pending_bytes += len(data)
+                return
+            self.sha256.update(data)
+            self.pos += len(data)
+            self.__drain()
+
+    def zero(self, offset, length):
+        """
+        Hash length zero bytes at offset, without the caller materializing them.
+        """
+        with self.lock:
+            if self.spilled:
+                return
+            self.gaps[offset] = length
+            self.__drain()
+
+    def __drain(self):
+        while True:
+            if self.pos in self.gaps:
+                self.__update_zero(self.gaps.pop(self.pos))
+            elif self.pos in self.pending:
+                data = self.pending.pop(self.pos)
+                self.pending_bytes -= len(data)
+                self.sha256.update(data)
+                self.pos += len(data)
+            else:
+                break
+
+    def __update_zero(self, length):
+        zero = bytes(min(length, 1048576))
+        while length:
+            n = min(length, len(zero))
+            self.sha256.update(zero[:n])
+            self.pos += n
+            length -= n
+
+    def digest(self):
+        if self.spilled:
+            digest = hashlib.sha256()
+            remaining = self.size
+            with self.source() if callable(self.source) else open(self.source, 'rb') as image:
+                while remaining and (data := image.read(min(remaining, 1048576))):
+                    digest.update(data)
+                    remaining -= len(data)
+            return digest.digest() if not remaining else None
+        if self.pos in self.gaps:
+            self.__update_zero(self.gaps.pop(self.pos))
+        if self.pos != self.size or self.pending:
+            return None
+        return self.sha256.digest()
+
+
+class ExtentWriter:
+    """
+    Spread a sequential stream of operation data over its dst_extents.
+    Data is gathered into buffers of up to WRITE_BUFFER bytes, so out_file sees few large block-aligned writes;
+    call flush() once the operation is done.
+    """
+
+    def __init__(self, out_file, extents, block_size, hasher=None):
+        self.out_file = out_file
+        self.extents = [(start_block * block_size, num_blocks * block_size) for start_block, num_blocks in extents]
+        self.idx = 0
+        self.left = 0
+        self.offset = 0
+        self.hasher = hasher
+        self.buffer = bytearray()
+
+    def next_extent(self):
+        self.flush()
+        if self.idx >= len(self.extents):
+            raise ValueError("Operation data exceeds its dst_extents")
+        self.offset, self.left = self.extents[self.idx]
+        self.idx += 1
+
+    def flush(self):
+        if not self.buffer:
+            return
+        offset = self.offset - len(self.buffer)
+        self.out_file.seek(offset)
+        self.out_file.write(self.buffer)
+        if self.hasher is not None:
+            self.hasher.update(offset, self.buffer)
+        self.buffer = bytearray()
+
+    def zero(self, length):
+        """
+        Zero length bytes. Output images are created empty, so raw images keep them as holes
+        and a SparseWriter gets FILL chunks.
+        """
+        while length:
+            if not self.left:
+                self.next_extent()
+            self.flush()
+            n = min(length, self.left)
+            if hasattr(self.out_file, 'fill'):
+                self.out_file.seek(self.offset)
+                self.out_file.fill(n)
+            if self.hasher is not None:
+                self.hasher.zero(self.offset, n)
+            self.offset += n
+            self.left -= n
+            length -= n
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view):
+            if not self.left:
+                self.next_extent()
+            n = min(len(view), self.left)
+            self.buffer += view[:n]
+            self.offset += n
+            self.left -= n
+            view = view[n:]
+            if len(self.buffer) >= WRITE_BUFFER:
+                self.flush()
+
+
+def zstd_decompressor() -> zstandard.ZstdDecompressor:
+    """
+    Return the zstd decompression context of the calling thread.
+    """
+    dctx = getattr(_zstd_local, 'dctx', None)
+    if dctx is None:
+        dctx = _zstd_local.dctx = zstandard.ZstdDecompressor()
+    return dctx
+
+
+def zstd_frames(data):
+    """
+    Split concatenated zstd frames, skippable frames are dropped.
+    :return: list of memoryviews, None if data can not be walked
+    """
+    view = memoryview(data)
+    frames = []
+    pos = 0
+    try:
+        while pos < len(view):
+            magic, = struct.unpack_from('<I', view, pos)
+            if magic & 0xFFFFFFF0 == 0x184D2A50:
+                pos += 8 + struct.unpack_from('<I', view, pos + 4)[0]
+                continue
+            if magic != 0xFD2FB528:
+                return None
+            start = pos
+            checksum = view[pos + 4] & 4
+            pos += zstandard.frame_header_size(view[pos:pos + 18])
+            while True:
+                header = int.from_bytes(view[pos:pos + 3], 'little')
+                if len(view[pos:pos + 3]) != 3 or header >> 1 & 3 == 3:
+                    return None
+                pos += 3 + (1 if header >> 1 & 3 == 1 else header >> 3)
+                if header & 1:
+                    break
+            pos += 4 if checksum else 0
+            frames.append(view[start:pos])
+    except (struct.error, IndexError, zstandard.ZstdError):
+        return None
+    return frames if pos == len(view) else None
+
+
+def _frame_executor() -> ThreadPoolExecutor:
+    """
+    Shared frame pool of this process, call with _frame_pool_lock held.
+    """
+    global _frame_pool
+    # A pool inherited through fork has no threads, give every process its own.
+    if _frame_pool is None or _frame_pool[0] != os.getpid():
+        _frame_pool = os.getpid(), ThreadPoolExecutor(max_workers=cpu_count())
+    return _frame_pool[1]
+
+
+def shutdown_frame_pool():
+    """
+    Stop the threads of the frame pool, the next parallel decompression starts a new one.
+    """
+    global _frame_pool
+    with _frame_pool_lock:
+        pool, _frame_pool = _frame_pool, None
+    if pool is not None and pool[0] == os.getpid():
+        pool[1].shutdown()
+
+
+def _decompress_frame(frame, max_output_size):
+    return zstd_decompressor().decompress(frame, max_output_size=max_output_size)
+
+
+def _decompress_frames(frames, max_output_size):
+    return [_decompress_frame(frame, max_output_size) for frame in frames]
+
+
+def zstd_decompress(data, max_output_size) -> list:
+    """
+    Decompress the zstd data of a whole operation, its independent frames are decompressed in parallel.
+    :param max_output_size: upper bound of the output, used for frames without a content size
+    :return: list of decompressed chunks, in order
+    """
+    frames = zstd_frames(data)
+    if frames is None:
+        return [zstd_decompressor().decompressobj(read_across_frames=True).decompress(data)]
+    with _busy_lock:
+        idle = cpu_count() - _busy_ops
+    # The calling thread takes one share of the frames, idle CPUs the others
+    shares = min(len(frames), idle + 1) if _parallel_frames else 1
+    if shares <= 1:
+        return _decompress_frames(frames, max_output_size)
+    with _frame_pool_lock:
+        executor = _frame_executor()
+        futures = [executor.submit(_decompress_frames, frames[i::shares], max_output_size) for i in range(1, shares)]
+    chunks = [None] * len(frames)
+    chunks[::shares] = _decompress_frames(frames[::shares], max_output_size)
+    for i, future in enumerate(futures, 1):
+        chunks[i::shares] = future.result()
+    return chunks
+
+
+class MappedFile:
+    """
+    Present extents of a larger file, like a partition inside super, as a file starting at 0.
+    :param extents: list of (offset in file, length)
+    """
+
+    def __init__(self, file, extents):
+        self.file = file
+        self.extents = extents
+        self.pos = 0
+        if hasattr(file, 'fill'):
+            self.fill = self.__fill
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence != io.SEEK_SET:
+            raise ValueError("MappedFile only supports SEEK_SET and SEEK_CUR")
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def __map(self, length):
+        base = 0
+        for offset, extent_length in self.extents:
+            if length and self.pos < base + extent_length:
+                n = min(length, base + extent_length - self.pos)
+                yield offset + self.pos - base, n
+                self.pos += n
+                length -= n
+            base += extent_length
+        if length:
+            raise ValueError("Write past the end of the mapped extents")
+
+    def write(self, data):
+        view = memoryview(data)
+        for offset, n in self.__map(len(view)):
+            self.file.seek(offset)
+            self.file.write(view[:n])
+            view = view[n:]
+        return len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def __fill(self, length):
+        for offset, n in self.__map(length):
+            self.file.seek(offset)
+            self.file.fill(n)
+
+
+def apply_op(op: OpDescriptor, payloadfile, out_file, old_file, block_size, buffsize, hasher=None,
+             verify=False) -> bool:
+    """
+    Write one operation to out_file.
+    With verify, the operation data is hashed while it is read and False is returned on a mismatch.
+    """
+    global _busy_ops
+    with _busy_lock:
+        _busy_ops += 1
+    try:
+        return _apply_op(op, payloadfile, out_file, old_file, block_size, buffsize, hasher, verify)
+    finally:
+        with _busy_lock:
+            _busy_ops -= 1
+
+
+def _apply_op(op: OpDescriptor, payloadfile, out_file, old_file, block_size, buffsize, hasher, verify) -> bool:
+    payloadfile.seek(op.data_offset)
+    processed_len = 0
+    data_length = op.data_length
+    data_hash = hashlib.sha256() if verify and op.data_sha256_hash else None
+
+    def read_data(size):
+        buf = payloadfile.read(size)
+        if data_hash is not None:
+            data_hash.update(buf)
+        return buf
+
+    op_type = op.type
+    writer = ExtentWriter(out_file, op.dst_extents, block_size, hasher)
+    if op_type == Op.REPLACE_ZSTD and data_length <= ZSTD_WHOLE_OP:
+        data = read_data(data_length)
+        # Some payloads mark uncompressed data as REPLACE_ZSTD.
+        if data[:4] != ZSTD_MAGIC:
+            writer.write(data)
+        else:
+            for chunk in zstd_decompress(data, sum(num_blocks for _, num_blocks in op.dst_extents) * block_size):
+                writer.write(chunk)
+    elif op_type == Op.REPLACE_ZSTD:
+        dec = None
+        while processed_len < data_length:
+            data = read_data(min(max(buffsize, WRITE_BUFFER), data_length - processed_len))
+            if not processed_len and data[:4] == ZSTD_MAGIC:
+                dec = zstd_decompressor().decompressobj(read_across_frames=True)
+            processed_len += len(data)
+            writer.write(data if dec is None else dec.decompress(data))
+    elif op_type == Op.REPLACE_XZ:
+        dec = lzma.LZMADecompressor()
+        while processed_len < data_length:
+            data = read_data(min(buffsize, data_length - processed_len))
+            processed_len += len(data)
+            while True:
+                data = dec.decompress(data, max_length=buffsize)
+                writer.write(data)
+                if dec.needs_input or dec.eof:
+                    break
+                data = b''
+    elif op_type == Op.REPLACE_BZ:
+        dec = bz2.BZ2Decompressor()
+        while processed_len < data_length:
+            data = read_data(min(buffsize, data_length - processed_len))
+            processed_len += len(data)
+            while True:
+                data = dec.decompress(data, max_length=buffsize)
+                writer.write(data)
+                if dec.needs_input or dec.eof:
+                    break
+                data = b''
+    elif op_type == Op.REPLACE:
+        while processed_len < data_length:
+            data = read_data(min(buffsize, data_length - processed_len))
+            processed_len += len(data)
+            writer.write(data)
+
+    elif op_type == Op.SOURCE_COPY:
+        if old_file is None:
+            print("SOURCE_COPY supported only for differential OTA")
+            sys.exit(-2)
+        for start_block, num_blocks in op.src_extents:
+            old_file.seek(start_block * block_size)
+            data_length = num_blocks * block_size
+            while processed_len < data_length:
+                data = old_file.read(min(buffsize, data_length - processed_len))
+                processed_len += len(data)
+                writer.write(data)
+            processed_len = 0
+    elif op_type == Op.ZERO:
+        writer.zero(sum(num_blocks for _, num_blocks in op.dst_extents) * block_size)
+    else:
+        print(f"Unsupported type = {op.type:d}")
+        sys.exit(-1)
+    writer.flush()
+    return data_hash is None or data_hash.digest() == op.data_sha256_hash
+
+
+def _init_process_worker(payloadpath, block_size, buffsize, verify):
+    global _parallel_frames
+    _parallel_frames = False
+    _process_context.update(payloadpath=payloadpath, block_size=block_size, buffsize=buffsize, verify=verify)
+
+
+def _process_op(out_path, old_path, op: OpDescriptor) -> bool:
+    """
+    Apply one operation inside a worker process with its own payload and image handles.
+    """
+    ctx = _process_context
+    with open(ctx['payloadpath'], 'rb') as payloadfile, open(out_path, 'r+b') as out_file:
+        if old_path:
+            with open(old_path, 'rb') as old_file:
+                return apply_op(op, payloadfile, out_file, old_file, ctx['block_size'], ctx['buffsize'],
+                                verify=ctx['verify'])
+        return apply_op(op, payloadfile, out_file, None, ctx['block_size'], ctx['buffsize'], verify=ctx['verify'])
 
 
 class Dumper:
     def __init__(
-            self, payloadfile, out, diff=None, old=None, images="", workers=cpu_count(), buffsize=8192
+            self, payloadfile, out, diff=None, old=None, images="", workers=cpu_count(), buffsize=8192,
+            split_ops=False, backend='thread', verify=False, member=None, sparse=False, index_dir=None
     ):
         self.payloadpath = payloadfile
+        # An http(s) url is dumped through range requests, fetching only the data of the selected partitions.
+        self.remote = payloadfile.startswith(('http://', 'https://'))
+        # Offset of payload.bin inside payloadfile, it is read in place when payloadfile is an OTA zip.
+        self.payload_offset = 0
+        if member:
+            with self.open_payloadfile() as zip_file:
+                self.payload_offset = zip_member_offset(zip_file, member)
         payloadfile = self.open_payloadfile()
         self.payloadfile = payloadfile
         self.tls = threading.local()
@@ -44,21 +535,40 @@ class Dumper:
         self.images = images
         self.workers = workers
         self.buffsize = buffsize
+        # Fan the operations of every partition out to the pool instead of one thread per partition.
+        self.split_ops = split_ops
+        # 'process' decodes operations in worker processes, only OpDescriptors are pickled.
+        self.backend = backend
+        # Check data_sha256_hash of every operation and the hash of every written partition.
+        self.verify = verify
+        self.hash_errors = []
+        # Write Android sparse images: ZERO operations become FILL chunks, unwritten blocks DONT_CARE.
+        self.sparse = sparse
+        # Cache directory of payload indexes, see payload_index.
+        self.index_dir = index_dir
         self.validate_magic()
 
     def open_payloadfile(self):
-        return open(self.payloadpath, 'rb')
+        if self.remote:
+            payloadfile = io.BufferedReader(HttpFile(self.payloadpath), 65536)
+        else:
+            payloadfile = open(self.payloadpath, 'rb')
+        payloadfile.seek(self.payload_offset)
+        return payloadfile
 
-    def run(self, slow=False) -> bool:
+    def select_partitions(self):
+        """
+        Return the partitions chosen by images as dicts of "partition" (PartitionEntry) and "operations".
+        """
         if self.images == "":
-            partitions = self.dam.partitions
+            partitions = self.index.partitions
         else:
             partitions = []
             for image in self.images:
                 found = False
-                for dam_part in self.dam.partitions:
-                    if dam_part.partition_name == image:
-                        partitions.append(dam_part)
+                for entry in self.index.partitions:
+                    if entry.name == image:
+                        partitions.append(entry)
                         found = True
                         break
                 if not found:
@@ -66,33 +576,104 @@ class Dumper:
 
         if len(partitions) == 0:
             print("Not operating on any partitions")
+        return [{"partition": partition, "operations": partition.operations} for partition in partitions]
+
+    def run(self, slow=False) -> bool:
+        partitions_with_ops = self.select_partitions()
+        if not partitions_with_ops:
             return False
 
-        partitions_with_ops = []
-        for partition in partitions:
-            operations = []
-            for operation in partition.operations:
-                self.payloadfile.seek(self.data_offset + operation.data_offset)
-                operations.append(
-                    {
-                        "data_offset": self.payloadfile.tell(),
-                        "operation": operation,
-                        "data_length": operation.data_length,
-                    }
-                )
-            partitions_with_ops.append(
-                {
-                    "partition": partition,
-                    "operations": operations,
-                }
-            )
+        self.payloadfile.close()
+        try:
+            if self.remote:
+                if self.sparse:
+                    print("Sparse output is not supported for remote payloads, writing raw images")
+                self.multiprocess_remote(partitions_with_ops)
+            elif slow:
+                self.extract_slow(partitions_with_ops)
+            elif (self.split_ops or self.backend == 'process') and not self.sparse:
+                self.multiprocess_ops(partitions_with_ops)
+            else:
+                self.multiprocess_partitions(partitions_with_ops)
+        finally:
+            shutdown_frame_pool()
+        return not self.hash_errors
 
+    def dump_super(self, super_path, layout, sparse=False) -> bool:
+        """
+        Write the selected partitions straight into their extents inside one super image,
+        the selected partitions that are not in the layout are dumped as separate images.
+        :param layout: lpmake.SuperLayout, partitions are found by name or by name with _a
+        """
+        partitions = self.select_partitions()
+        if not partitions:
+            return False
+        if self.remote:
+            print("Super images can not be built from remote payloads")
+            return False
         self.payloadfile.close()
-        if slow:
-            self.extract_slow(partitions_with_ops)
-        else:
-            self.multiprocess_partitions(partitions_with_ops)
-        return True
+        in_super = []
+        others = []
+        for part in partitions:
+            name = part["partition"].name
+            extents = layout.extents.get(name) or layout.extents.get(f'{name}_a')
+            if not extents:
+                others.append(part)
+                continue
+            if sum(length for _, length in extents) < part["partition"].size:
+                raise ValueError(f"{name} does not fit in its extents of super")
+            part["super_extents"] = extents
+            in_super.append(part)
+        in_super.sort(key=lambda x: x["super_extents"][0][0])
+        try:
+            with open(super_path, 'wb') as super_file:
+                if sparse:
+                    writer = SparseWriter(super_file, self.block_size, layout.device_size // self.block_size)
+                    writer.write(layout.metadata_region())
+                    # A sparse image is written in one increasing pass, partition after partition.
+                    for part in in_super:
+                        name = part["partition"].name
+                        mapped = MappedFile(writer, part["super_extents"])
+                        if (ordered := self.sparse_order(part["operations"])) is not None:
+                            self.write_part(part, mapped, ordered)
+                        else:
+                            print(f"{name}: operations overlap, copying it from a raw image")
+                            self.dump_part(part, sparse=False)
+                            with open(f"{self.out}/{name}.img", "rb") as image:
+                                shutil.copyfileobj(image, mapped, WRITE_BUFFER)
+                            os.remove(f"{self.out}/{name}.img")
+                        print(f"{name} Done!")
+                    writer.close()
+                else:
+                    super_file.truncate(layout.device_size)
+                    super_file.write(layout.metadata_region())
+            if not sparse:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    futures = {executor.submit(self.dump_part_into, part, super_path): part for part in in_super}
+                    for future in as_completed(futures):
+                        future.result()
+                        print(f"{futures[future]['partition'].name} Done!")
+            if others:
+                self.multiprocess_partitions(others)
+        finally:
+            shutdown_frame_pool()
+        return not self.hash_errors
+
+    def super_layout(self, group_name, size, super_type, attrib='readonly', block_device_name='super'):
+        """
+        Lay out super like pack_super does, for the selected partitions of the dynamic partition groups of the payload.
+        """
+        dynamic = {name for _, _, names in self.index.groups for name in names}
+        if self.images:
+            dynamic &= set(self.images)
+        sizes = [(part.name, part.size) for part in self.index.partitions if part.name in dynamic]
+        return lpmake.super_layout(sizes, group_name, size, super_type, attrib, block_device_name)
+
+    def dump_part_into(self, part, super_path):
+        extents = part["super_extents"]
+        with open(super_path, 'r+b') as super_file:
+            self.write_part(part, MappedFile(super_file, extents), list(enumerate(part["operations"])),
+                            lambda: LpPartitionFile(open(super_path, 'rb'), extents))
 
     def extract_slow(self, partitions):
         for part in partitions:
@@ -102,117 +683,226 @@ class Dumper:
         with ThreadPoolExecutor(max_workers=self.workers) as executor:
             futures = {executor.submit(self.dump_part, part): part for part in partitions}
             for future in as_completed(futures):
-                partition_name = futures[future]['partition'].partition_name
+                partition_name = futures[future]['partition'].name
                 future.result()
                 print(f"{partition_name} Done!")
 
+    def multiprocess_ops(self, partitions):
+        if self.backend == 'process':
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_process_worker,
+                                           initargs=(self.payloadpath, self.block_size, self.buffsize, self.verify))
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+        with executor:
+            futures = {}
+            remaining = {}
+            for part in partitions:
+                partition_name = part['partition'].name
+                self.create_part(part)
+                remaining[partition_name] = len(part["operations"])
+                if not part["operations"]:
+                    self.verify_part(part)
+                    print(f"{partition_name} Done!")
+                for index, op in enumerate(part["operations"]):
+                    if self.backend == 'process':
+                        future = executor.submit(_process_op, f"{self.out}/{partition_name}.img",
+                                                 f"{self.old}/{partition_name}.img" if self.diff else None, op)
+                    else:
+                        future = executor.submit(self.dump_op, part, op)
+                    futures[future] = part, index
+            for future in as_completed(futures):
+                part, index = futures[future]
+                partition_name = part['partition'].name
+                if not future.result():
+                    self.report_op_mismatch(partition_name, index)
+                remaining[partition_name] -= 1
+                if not remaining[partition_name]:
+                    self.verify_part(part)
+                    print(f"{partition_name} Done!")
+
+    def multiprocess_remote(self, partitions):
+        """
+        Fetch the data of the selected operations with coalesced range requests run in parallel,
+        then apply every operation from its fetched span.
+        """
+        ops = []
+        remaining = {}
+        for part in partitions:
+            partition_name = part['partition'].name
+            self.create_part(part)
+            remaining[partition_name] = len(part["operations"])
+            if not part["operations"]:
+                self.verify_part(part)
+                print(f"{partition_name} Done!")
+            ops.extend((op, (part, index)) for index, op in enumerate(part["operations"]))
+        spans = coalesce_ranges([i for i in ops if i[0].data_length])
+        if no_data := [i for i in ops if not i[0].data_length]:
+            spans.append((0, 0, no_data))
+        with HttpFile(self.payloadpath) as http, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.dump_span, http, span) for span in spans]
+            for future in as_completed(futures):
+                for (part, index), result in future.result():
+                    partition_name = part['partition'].name
+                    if not result:
+                        self.report_op_mismatch(partition_name, index)
+                    remaining[partition_name] -= 1
+                    if not remaining[partition_name]:
+                        self.verify_part(part)
+                        print(f"{partition_name} Done!")
+            print(f"Fetched {http.total_bytes} bytes of {http.size}")
+
+    def dump_span(self, http, span):
+        start, length, members = span
+        self.tls.payloadfile = SpanReader(http.read_range(start, length), start)
+        results = []
+        for op, (part, index) in members:
+            with open(f"{self.out}/{part['partition'].name}.img", "r+b") as out_file:
+                results.append(((part, index), self.data_for_op(op, out_file, None, part["hasher"])))
+        return results
+
     def validate_magic(self):
-        magic = self.payloadfile.read(4)
-        assert magic == b"CrAU"
-        file_format_version = u64(self.payloadfile.read(8))
-        assert file_format_version == 2
-        manifest_size = u64(self.payloadfile.read(8))
-        metadata_signature_size = 0
-        if file_format_version > 1:
-            metadata_signature_size = u32(self.payloadfile.read(4))
-        manifest = self.payloadfile.read(manifest_size)
-        self.metadata_signature = self.payloadfile.read(metadata_signature_size)
-        self.data_offset = self.payloadfile.tell()
-        self.dam = um.DeltaArchiveManifest()
-        self.dam.ParseFromString(manifest)
-        self.block_size = self.dam.block_size
-
-    def data_for_op(self, operation, out_file, old_file):
-        payloadfile = self.tls.payloadfile
-        payloadfile.seek(operation["data_offset"])
-        buffsize = self.buffsize
-        processed_len = 0
-        data_length = operation["data_length"]
-        op = operation["operation"]
-
-        # assert hashlib.sha256(data).digest() == op.data_sha256_hash, 'operation data hash mismatch'
-        op_type = op.type
-        if op.type == op.REPLACE_ZSTD:
-            if payloadfile.read(4) != b'(\xb5/\xfd':
-                op_type = op.REPLACE
-            payloadfile.seek(payloadfile.tell() - 4)
-        if op_type == op.REPLACE_ZSTD:
-            dec = zstandard.ZstdDecompressor().decompressobj()
-            while processed_len < data_length:
-                data = payloadfile.read(buffsize)
-                processed_len += len(data)
-                data = dec.decompress(data)
-                out_file.write(data)
-                out_file.write(dec.flush())
-        elif op_type == op.REPLACE_XZ:
-            dec = lzma.LZMADecompressor()
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            while processed_len < data_length:
-                data = payloadfile.read(buffsize)
-                processed_len += len(data)
-                while True:
-                    data = dec.decompress(data, max_length=buffsize)
-                    out_file.write(data)
-                    if dec.needs_input or dec.eof:
-                        break
-                    data = b''
-        elif op_type == op.REPLACE_BZ:
-            dec = bz2.BZ2Decompressor()
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            while processed_len < data_length:
-                data = payloadfile.read(buffsize)
-                processed_len += len(data)
-                while True:
-                    data = dec.decompress(data, max_length=buffsize)
-                    out_file.write(data)
-                    if dec.needs_input or dec.eof:
-                        break
-                    data = b''
-        elif op_type == op.REPLACE:
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            while processed_len < data_length:
-                data = payloadfile.read(buffsize)
-                processed_len += len(data)
-                out_file.write(data)
-
-        elif op_type == op.SOURCE_COPY:
-            if not self.diff:
-                print("SOURCE_COPY supported only for differential OTA")
-                sys.exit(-2)
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            for ext in op.src_extents:
-                old_file.seek(ext.start_block * self.block_size)
-                data_length = ext.num_blocks * self.block_size
-                while processed_len < data_length:
-                    data = old_file.read(buffsize)
-                    processed_len += len(data)
-                    out_file.write(data)
-                processed_len = 0
-        elif op_type == op.ZERO:
-            for ext in op.dst_extents:
-                out_file.seek(ext.start_block * self.block_size)
-                data_length = ext.num_blocks * self.block_size
-                while processed_len < data_length:
-                    data = bytes(min(data_length - processed_len, buffsize))
-                    out_file.write(data)
-                    processed_len += len(data)
-                processed_len = 0
+        """
+        Load the payload index, from index_dir when it was cached there, else by parsing the manifest.
+        """
+        if self.remote or not self.index_dir:
+            self.index = read_index(self.payloadfile)
         else:
-            print(f"Unsupported type = {op.type:d}")
-            sys.exit(-1)
-        del data
+            self.index = load_index(self.payloadpath, self.payload_offset, self.index_dir, self.payloadfile)
+        self.data_offset = self.index.data_offset
+        self.block_size = self.index.block_size
 
-    def dump_part(self, part):
-        name = part["partition"].partition_name
-        out_file = open(f"{self.out}/{name}.img", "wb")
+    def data_for_op(self, operation, out_file, old_file, hasher=None) -> bool:
+        return apply_op(operation, self.tls.payloadfile, out_file, old_file, self.block_size, self.buffsize,
+                        hasher, self.verify)
+
+    def report_op_mismatch(self, partition_name, index):
+        print(f"{partition_name}: operation {index} data hash mismatch!")
+        self.hash_errors.append((partition_name, index))
 
-        if self.diff:
-            old_file = open(f"{self.old}/{name}.img", "rb")
+    def new_hasher(self, part, source=None):
+        """
+        :param source: raw image the operations are written to, a path or a callable opening it.
+                       It is read back if too many writes arrive out of order
+        """
+        if not self.verify or not part["partition"].hash:
+            return None
+        extents = [(start_block * self.block_size, num_blocks * self.block_size)
+                   for op in part["operations"] for start_block, num_blocks in op.dst_extents]
+        return PartitionHasher(part["partition"].size, extents, source)
+
+    def verify_part(self, part):
+        """
+        Compare the hash collected while writing a partition with new_partition_info.hash.
+        The process backend never sees the written data, so its images are hashed from disk instead.
+        """
+        partition = part["partition"]
+        if not self.verify or not partition.hash:
+            return
+        hasher = part.get("hasher")
+        if hasher is not None:
+            digest = hasher.digest()
         else:
-            old_file = None
+            digest = hashlib.sha256()
+            with open(f"{self.out}/{partition.name}.img", "rb") as image:
+                while data := image.read(1048576):
+                    digest.update(data)
+            digest = digest.digest()
+        if digest is None:
+            print(f"{partition.name}: written extents do not cover the image, hash not checked")
+        elif digest != partition.hash:
+            print(f"{partition.name}: partition hash mismatch!")
+            self.hash_errors.append((partition.name, None))
+
+    def allocate_part(self, part, out_file):
+        """
+        Size a new raw image. Blocks written by data operations are preallocated where the platform
+        has posix_fallocate, ZERO extents and unwritten ranges are left as holes.
+        """
+        out_file.truncate(part["partition"].size)
+        if not hasattr(os, 'posix_fallocate'):
+            return
+        extents = []
+        for start_block, num_blocks in sorted(ext for op in part["operations"] if op.type != Op.ZERO
+                                              for ext in op.dst_extents):
+            if extents and extents[-1][0] + extents[-1][1] == start_block:
+                extents[-1] = (extents[-1][0], extents[-1][1] + num_blocks)
+            else:
+                extents.append((start_block, num_blocks))
+        try:
+            for start_block, num_blocks in extents:
+                os.posix_fallocate(out_file.fileno(), start_block * self.block_size, num_blocks * self.block_size)
+        except OSError:
+            pass
+
+    def create_part(self, part):
+        """
+        Create the output image at its final size so operations can be written at any offset.
+        """
+        name = part["partition"].name
+        with open(f"{self.out}/{name}.img", "wb") as out_file:
+            self.allocate_part(part, out_file)
+        if self.backend != 'process':
+            part["hasher"] = self.new_hasher(part, f"{self.out}/{name}.img")
 
+    def dump_op(self, part, operation) -> bool:
+        name = part["partition"].name
+        with self.open_payloadfile() as payloadfile, open(f"{self.out}/{name}.img", "r+b") as out_file:
+            self.tls.payloadfile = payloadfile
+            if self.diff:
+                with open(f"{self.old}/{name}.img", "rb") as old_file:
+                    return self.data_for_op(operation, out_file, old_file, part["hasher"])
+            return self.data_for_op(operation, out_file, None, part["hasher"])
+
+    @staticmethod
+    def sparse_order(operations):
+        """
+        Return the operations sorted by destination block, or None if their dst_extents
+        can not be written in one increasing pass.
+        """
+        ordered = sorted(enumerate(operations), key=lambda x: x[1].dst_extents[0][0] if x[1].dst_extents else -1)
+        pos = 0
+        for _, op in ordered:
+            for start_block, num_blocks in op.dst_extents:
+                if start_block < pos:
+                    return None
+                pos = start_block + num_blocks
+        return ordered
+
+    def write_part(self, part, writer, operations, source=None):
+        """
+        Apply operations, a list of (index, OpDescriptor), to writer and check the partition hash.
+        :param source: the written image for new_hasher, needed unless operations are in destination order
+        """
+        name = part["partition"].name
+        old_file = open(f"{self.old}/{name}.img", "rb") if self.diff else None
+        part["hasher"] = self.new_hasher(part, source)
         with self.open_payloadfile() as payloadfile:
             self.tls.payloadfile = payloadfile
-            for op in part["operations"]:
-                self.data_for_op(op, out_file, old_file)
+            for index, op in operations:
+                if not self.data_for_op(op, writer, old_file, part["hasher"]):
+                    self.report_op_mismatch(name, index)
+        if old_file is not None:
+            old_file.close()
+        if source is not None:
+            writer.flush()
+        self.verify_part(part)
+
+    def dump_part(self, part, sparse=None):
+        name = part["partition"].name
+        out_file = open(f"{self.out}/{name}.img", "wb")
+
+        operations = list(enumerate(part["operations"]))
+        writer = out_file
+        if self.sparse if sparse is None else sparse:
+            if (ordered := self.sparse_order(part["operations"])) is None:
+                print(f"{name}: operations overlap, writing a raw image")
+            else:
+                operations = ordered
+                size = part["partition"].size
+                writer = SparseWriter(out_file, self.block_size, (size + self.block_size - 1) // self.block_size)
+        if writer is out_file:
+            self.allocate_part(part, out_file)
+        self.write_part(part, writer, operations, f"{self.out}/{name}.img" if writer is out_file else None)
+        if writer is not out_file:
+            writer.close()
         out_file.close()
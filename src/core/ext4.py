@@ -1,9 +1,15 @@
 # pylint: disable=line-too-long
 import ctypes
+from bisect import bisect_right
+from collections import OrderedDict
 from functools import cmp_to_key
 import io
 from math import log as log_math
+import mmap
+import os
 import queue
+import struct
+import sys
 
 
 def wcs_cmp(str_a, str_b):
@@ -80,6 +86,9 @@ class ext4_extent(ext4_struct):
         ("ee_start_lo", ctypes.c_uint)  # 0x0008
     ]
 
+    # ee_len above this marks an uninitialized extent of ee_len - EXT_INIT_MAX_LEN blocks
+    EXT_INIT_MAX_LEN = 0x8000
+
 
 class ext4_extent_header(ext4_struct):
     _fields_ = [
@@ -427,6 +436,111 @@ class InodeType:
     CHECKSUM = 0xDE  # Checksum entry; not really a file type, but a type of directory entry
 
 
+# ----------------------------- HTREE HASH ------------------------------
+# Directory hashes of fs/ext4/hash.c, used to look names up in hash tree (EXT4_INDEX_FL) directories
+
+DX_HASH_LEGACY = 0
+DX_HASH_HALF_MD4 = 1
+DX_HASH_TEA = 2
+DX_HASH_LEGACY_UNSIGNED = 3
+DX_HASH_HALF_MD4_UNSIGNED = 4
+DX_HASH_TEA_UNSIGNED = 5
+EXT2_FLAGS_UNSIGNED_HASH = 0x2
+_U32 = 0xFFFFFFFF
+
+
+def _rol32(value, shift):
+    return ((value << shift) | (value >> (32 - shift))) & _U32
+
+
+def _dx_hack_hash(name, signed):
+    hash0, hash1 = 0x12A3FE2D, 0x37ABE8F9
+    for c in name:
+        if signed and c > 127:
+            c -= 256
+        value = (hash1 + (hash0 ^ (c * 7152373 & _U32))) & _U32
+        if value & 0x80000000:
+            value = (value - 0x7FFFFFFF) & _U32
+        hash1, hash0 = hash0, value
+    return hash0 << 1 & _U32
+
+
+def _str2hashbuf(name, num, signed):
+    pad = len(name) | len(name) << 8
+    pad |= pad << 16
+    pad &= _U32
+    value = pad
+    buf = []
+    for i, c in enumerate(name[:num * 4]):
+        if signed and c > 127:
+            c -= 256
+        value = (c + (value << 8)) & _U32
+        if i % 4 == 3:
+            buf.append(value)
+            value = pad
+    if len(buf) < num:
+        buf.append(value)
+    return buf + [pad] * (num - len(buf))
+
+
+def _half_md4_transform(buf, data):
+    a, b, c, d = buf
+    f = lambda x, y, z: z ^ (x & (y ^ z))
+    g = lambda x, y, z: ((x & y) + ((x ^ y) & z)) & _U32
+    h = lambda x, y, z: x ^ y ^ z
+    for func, k, order, shifts in (
+            (f, 0, (0, 1, 2, 3, 4, 5, 6, 7), (3, 7, 11, 19)),
+            (g, 0x5A827999, (1, 3, 5, 7, 0, 2, 4, 6), (3, 5, 9, 13)),
+            (h, 0x6ED9EBA1, (3, 7, 2, 6, 1, 5, 0, 4), (3, 9, 11, 15))):
+        for n, i in enumerate(order):
+            shift = shifts[n % 4]
+            x = (data[i] + k) & _U32
+            if n % 4 == 0:
+                a = _rol32((a + func(b, c, d) + x) & _U32, shift)
+            elif n % 4 == 1:
+                d = _rol32((d + func(a, b, c) + x) & _U32, shift)
+            elif n % 4 == 2:
+                c = _rol32((c + func(d, a, b) + x) & _U32, shift)
+            else:
+                b = _rol32((b + func(c, d, a) + x) & _U32, shift)
+    return [(buf[0] + a) & _U32, (buf[1] + b) & _U32, (buf[2] + c) & _U32, (buf[3] + d) & _U32]
+
+
+def _tea_transform(buf, data):
+    total = 0
+    b0, b1 = buf[0], buf[1]
+    a, b, c, d = data
+    for _ in range(16):
+        total = (total + 0x9E3779B9) & _U32
+        b0 = (b0 + ((((b1 << 4) + a) & _U32) ^ ((b1 + total) & _U32) ^ (((b1 >> 5) + b) & _U32))) & _U32
+        b1 = (b1 + ((((b0 << 4) + c) & _U32) ^ ((b0 + total) & _U32) ^ (((b0 >> 5) + d) & _U32))) & _U32
+    return [(buf[0] + b0) & _U32, (buf[1] + b1) & _U32, buf[2], buf[3]]
+
+
+def dx_hash(name: bytes, hash_version: int, seed=None):
+    """
+    Major hash of a file name, as stored in hash tree index entries.
+    :param seed: s_hash_seed of the superblock, the default seed is used when it is all zeros
+    """
+    buf = list(seed) if seed and any(seed) else [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476]
+    signed = hash_version < DX_HASH_LEGACY_UNSIGNED
+    hash_version %= 3
+    if hash_version == DX_HASH_LEGACY:
+        major = _dx_hack_hash(name, signed)
+    elif hash_version == DX_HASH_HALF_MD4:
+        for i in range(0, len(name), 32):
+            buf = _half_md4_transform(buf, _str2hashbuf(name[i:], 8, signed))
+        major = buf[1]
+    else:
+        for i in range(0, len(name), 16):
+            buf = _tea_transform(buf, _str2hashbuf(name[i:], 4, signed))
+        major = buf[0]
+    major &= ~1 & _U32
+    if major == 0x7FFFFFFF << 1:
+        major = 0x7FFFFFFE << 1
+    return major
+
+
 # ----------------------------- HIGH LEVEL ------------------------------
 
 class MappingEntry:
@@ -472,15 +586,65 @@ class MappingEntry:
             idx += 1
 
 
+class InodeTable:
+    """
+    Inode table of one block group, read with a single I/O up to the last inode in use.
+    """
+    EXT4_BG_INODE_UNINIT = 0x1
+
+    def __init__(self, volume, group_idx):
+        superblock = volume.superblock
+        descriptor = volume.group_descriptors[group_idx]
+        self.first_inode = group_idx * superblock.s_inodes_per_group + 1
+        self.inode_size = superblock.s_inode_size
+        self.table_offset = descriptor.bg_inode_table * volume.block_size
+
+        bitmap = b''
+        if not descriptor.bg_flags & InodeTable.EXT4_BG_INODE_UNINIT:
+            bitmap = volume.read(descriptor.bg_inode_bitmap * volume.block_size,
+                                 (superblock.s_inodes_per_group + 7) // 8).rstrip(b'\0')
+        count = min((len(bitmap) - 1) * 8 + bitmap[-1].bit_length(), superblock.s_inodes_per_group) if bitmap else 0
+        self.raw = volume.read(self.table_offset, count * self.inode_size)
+
+    def raw_inode(self, inode_idx):
+        """
+        Bytes of an ext4_inode struct from the table, None when they were not read.
+        """
+        start = (inode_idx - self.first_inode) * self.inode_size
+        raw = self.raw[start:start + ctypes.sizeof(ext4_inode)]
+        return raw if len(raw) == ctypes.sizeof(ext4_inode) else None
+
+
 class Volume:
     ROOT_INODE = 2
+    # Inode objects and group inode tables kept by bulk_inodes volumes
+    INODE_CACHE_SIZE = 8192
+    TABLE_CACHE_SIZE = 8
 
-    def __init__(self, stream, offset=0, ignore_flags=False, ignore_magic=False):
+    def __init__(self, stream, offset=0, ignore_flags=False, ignore_magic=False, use_mmap=False,
+                 bulk_inodes=False):
         self.ignore_flags = ignore_flags
         self.ignore_magic = ignore_magic
         self.offset = offset
         self.platform64 = True  # Initial value needed for Volume.read_struct
         self.stream = stream
+        # With use_mmap the image is mapped read-only and structs are decoded straight from the mapping,
+        # streams that cannot be mapped are read as usual
+        self.mmap = None
+        self.view = None
+        if use_mmap:
+            try:
+                self.mmap = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.mmap)
+            except (AttributeError, OSError, ValueError):
+                self.mmap = None
+        # With bulk_inodes inodes are decoded from whole group inode tables and kept in an LRU cache
+        self.bulk_inodes = bulk_inodes
+        self.inode_cache = OrderedDict()
+        self.table_cache = OrderedDict()
+        # xattr block number -> [(name, value)], and one shared object per distinct xattr value
+        self.xattr_blocks = {}
+        self.xattr_values = {}
 
         # Superblock
         self.superblock = self.read_struct(ext4_superblock, 0x400)
@@ -536,6 +700,13 @@ class Volume:
             ["Current Size", self.get_block_count * self.block_size]]
 
     def get_inode(self, inode_idx, file_type=InodeType.UNKNOWN):
+        if self.bulk_inodes:
+            inode = self.inode_cache.get(inode_idx)
+            if inode is not None:
+                self.inode_cache.move_to_end(inode_idx)
+                if file_type != InodeType.UNKNOWN:
+                    inode.file_type = file_type
+                return inode
         group_idx, inode_table_entry_idx = self.get_inode_group(inode_idx)
         try:
             inode_table_offset = self.group_descriptors[group_idx].bg_inode_table * self.block_size
@@ -543,21 +714,79 @@ class Volume:
             inode_table_offset = 99 * self.block_size
         inode_offset = inode_table_offset + inode_table_entry_idx * self.superblock.s_inode_size
 
-        return Inode(self, inode_offset, inode_idx, file_type)
+        if not self.bulk_inodes or not 0 <= group_idx < len(self.group_descriptors):
+            return Inode(self, inode_offset, inode_idx, file_type)
+        inode = Inode(self, inode_offset, inode_idx, file_type, raw=self.inode_table(group_idx).raw_inode(inode_idx))
+        self.inode_cache[inode_idx] = inode
+        if len(self.inode_cache) > Volume.INODE_CACHE_SIZE:
+            self.inode_cache.popitem(last=False)
+        return inode
+
+    def inode_table(self, group_idx):
+        table = self.table_cache.get(group_idx)
+        if table is None:
+            table = self.table_cache[group_idx] = InodeTable(self, group_idx)
+            if len(self.table_cache) > Volume.TABLE_CACHE_SIZE:
+                self.table_cache.popitem(last=False)
+        else:
+            self.table_cache.move_to_end(group_idx)
+        return table
 
     def get_inode_group(self, inode_idx):
         group_idx = (inode_idx - 1) // self.superblock.s_inodes_per_group
         inode_table_entry_idx = (inode_idx - 1) % self.superblock.s_inodes_per_group
         return group_idx, inode_table_entry_idx
 
+    def close(self):
+        """
+        Release the mapping, the stream is left open.
+        """
+        if self.mmap is not None:
+            self.view.release()
+            self.mmap.close()
+            self.view = self.mmap = None
+
     def read(self, offset, byte_len):
+        if self.mmap is not None:
+            return self.mmap[self.offset + offset:self.offset + offset + byte_len]
         if self.offset + offset != self.stream.tell():
             self.stream.seek(self.offset + offset, io.SEEK_SET)
 
         return self.stream.read(byte_len)
 
+    def readinto(self, offset, buffer):
+        """
+        Fill buffer with the bytes at offset, returns the number of bytes read.
+        """
+        view = memoryview(buffer).cast('B')
+        if self.view is not None:
+            data = self.view[self.offset + offset:self.offset + offset + len(view)]
+            view[:len(data)] = data
+            return len(data)
+        if self.offset + offset != self.stream.tell():
+            self.stream.seek(self.offset + offset, io.SEEK_SET)
+        pos = 0
+        while pos < len(view):
+            n = self.stream.readinto(view[pos:])
+            if not n:
+                break
+            pos += n
+        return pos
+
+    def fileno(self):
+        """
+        File descriptor of the underlying stream, None when it has none.
+        """
+        try:
+            return self.stream.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+
     def read_struct(self, structure, offset, platform64=None):
-        raw = self.read(offset, ctypes.sizeof(structure))
+        if self.view is not None:
+            raw = self.view[self.offset + offset:self.offset + offset + ctypes.sizeof(structure)]
+        else:
+            raw = self.read(offset, ctypes.sizeof(structure))
 
         if hasattr(structure, "_from_buffer_copy"):
             return structure._from_buffer_copy(raw, platform64=platform64 if platform64 else self.platform64)
@@ -576,13 +805,17 @@ class Volume:
 
 
 class Inode:
-    def __init__(self, volume, offset, inode_idx, file_type=InodeType.UNKNOWN):
+    def __init__(self, volume, offset, inode_idx, file_type=InodeType.UNKNOWN, raw=None):
         self.inode_idx = inode_idx
         self.offset = offset
         self.volume = volume
 
         self.file_type = file_type
-        self.inode = volume.read_struct(ext4_inode, offset)
+        self._reader = None
+        if raw is not None:
+            self.inode = ext4_inode.from_buffer_copy(raw)
+        else:
+            self.inode = volume.read_struct(ext4_inode, offset)
 
     def __len__(self):
         return self.inode.i_size
@@ -636,7 +869,7 @@ class Inode:
                 xattr_value = raw_data[
                               xattr_entry.e_value_offs + offset: xattr_entry.e_value_offs + offset + xattr_entry.e_value_size]
 
-            yield xattr_name, xattr_value
+            yield sys.intern(xattr_name), self.volume.xattr_values.setdefault(xattr_value, xattr_value)
 
             i += xattr_entry._size
 
@@ -665,8 +898,7 @@ class Inode:
                 raise Ext4Error(f"{current_path!r:s} (Inode {inode_idx:d}) is not a directory."
                                 )
 
-            file_name, inode_idx, file_type = next(
-                filter(lambda entry: entry[0] == part, current_inode.open_dir(decode_name)), (None, None, None))
+            file_name, inode_idx, file_type = current_inode.lookup(part, decode_name) or (None, None, None)
 
             if inode_idx is None:
                 current_path = "/".join(relative_path[:i])
@@ -767,22 +999,85 @@ class Inode:
         if not self.volume.ignore_flags and not self.is_dir:
             raise Ext4Error(f"Inode ({self.inode_idx:d}) is not a directory.")
 
-        # # Hash trees are compatible with linear arrays
-        if (self.inode.i_flags & ext4_inode.EXT4_INDEX_FL) != 0:
-            ...
+        # Hash trees are compatible with linear arrays, the index blocks read as empty entries
+        for name, inode_idx, file_type in self._dir_entries(self.open_read().read()):
+            yield decode_name(name), inode_idx, file_type
 
-        # Read raw directory content
-        raw_data = self.open_read().read()
+    def _dir_entries(self, raw_data):
         offset = 0
 
         while offset < len(raw_data):
             dirent = ext4_dir_entry_2._from_buffer_copy(raw_data, offset, platform64=self.volume.platform64)
 
             if dirent.file_type != InodeType.CHECKSUM:
-                yield decode_name(dirent.name), dirent.inode, dirent.file_type
+                yield dirent.name, dirent.inode, dirent.file_type
 
+            if dirent.rec_len == 0:
+                break
             offset += dirent.rec_len
 
+    def lookup(self, name, decode_name=None):
+        """
+        Return the (name, inode_idx, file_type) entry called name in this directory, or None.
+        Hash tree directories are searched through their index, others entry by entry.
+        """
+        if decode_name is None:
+            decode_name = lambda raw: raw.decode("utf8")
+        raw_name = name.encode("utf8") if isinstance(name, str) else name
+
+        if (self.inode.i_flags & ext4_inode.EXT4_INDEX_FL) != 0:
+            reader = self._index_reader()
+            leaf_blocks = self._htree_leaves(reader, raw_name)
+            if leaf_blocks is not None:
+                for block in leaf_blocks:
+                    for entry_name, inode_idx, file_type in self._dir_entries(reader.read_block(block)):
+                        if entry_name == raw_name and inode_idx:
+                            return decode_name(entry_name), inode_idx, file_type
+                return None
+
+        for entry in self.open_dir(decode_name):
+            if entry[0] == name and entry[1]:
+                return entry
+        return None
+
+    def _index_reader(self):
+        # Block mapping of an indexed directory, kept for repeated lookups
+        if self._reader is None:
+            self._reader = self.open_read()
+        return self._reader
+
+    def _htree_leaves(self, reader, raw_name):
+        """
+        Directory blocks that may hold raw_name according to the hash tree, None when the index cannot be used.
+        """
+        block_size = self.volume.block_size
+        root = reader.read_block(0)
+        hash_version, info_length, indirect_levels = struct.unpack_from('<3B', root, 0x1C)
+        if hash_version > DX_HASH_TEA or info_length != 8 or indirect_levels > 2:
+            return None
+        superblock = self.volume.superblock
+        if superblock.s_flags & EXT2_FLAGS_UNSIGNED_HASH:
+            hash_version += DX_HASH_LEGACY_UNSIGNED
+        target = dx_hash(raw_name, hash_version, list(superblock.s_hash_seed))
+
+        node, offset = root, 0x18 + info_length
+        for level in range(indirect_levels + 1):
+            limit, count, first_block = struct.unpack_from('<2HI', node, offset)
+            if not count or count > limit or offset + count * 8 > block_size:
+                return None
+            entries = [(0, first_block)] + [struct.unpack_from('<2I', node, offset + i * 8) for i in range(1, count)]
+            idx = bisect_right([entry_hash for entry_hash, _ in entries], target) - 1
+            if level < indirect_levels:
+                node, offset = reader.read_block(entries[idx][1]), 8
+                continue
+            leaves = [entries[idx][1]]
+            # A name whose hash collides with the next block's first hash may continue there
+            for entry_hash, block in entries[idx + 1:]:
+                if entry_hash & ~1 != target:
+                    break
+                leaves.append(block)
+            return leaves
+
     def open_read(self):
         if (self.inode.i_flags & ext4_inode.EXT4_EXTENTS_FL) != 0:
             # Obtain mapping from extents
@@ -809,7 +1104,9 @@ class Inode:
                     extents = self.volume.read_struct(ext4_extent * header.eh_entries,
                                                       header_offset + ctypes.sizeof(ext4_extent_header))
                     for extent in extents:
-                        mapping.append(MappingEntry(extent.ee_block, extent.ee_start, extent.ee_len))
+                        # Uninitialized extents read as zeros, they are holes here
+                        if extent.ee_len <= ext4_extent.EXT_INIT_MAX_LEN:
+                            mapping.append(MappingEntry(extent.ee_block, extent.ee_start, extent.ee_len))
 
             MappingEntry.optimize(mapping)
             return BlockReader(self.volume, len(self), mapping)
@@ -848,28 +1145,34 @@ class Inode:
                     yield xattr_name, xattr_value
             except BaseException and Exception:
                 ...
-        # xattr block(s)
+        # xattr block(s), shared by many inodes so parsed once per volume
         if check_block and self.inode.i_file_acl != 0:
-            xattrs_block_start = self.inode.i_file_acl * self.volume.block_size
-            xattrs_block = self.volume.read(xattrs_block_start, self.volume.block_size)
-            if xattrs_block:
-                xattrs_header = ext4_xattr_header.from_buffer_copy(xattrs_block)
-                if not self.volume.ignore_magic and xattrs_header.h_magic != 0xEA020000:
-                    # Perhaps you think this code is a bit foolish, but that's all others can do
-                    print(f"Invalid magic value in xattrs block header at offset 0x{xattrs_block_start:X} of "
-                          f"inode {self.inode_idx:d}: 0x{xattrs_header.h_magic} (expected 0xEA020000)")
-                    return '', ''
-
-                if xattrs_header.h_blocks != 1:
-                    print(f"Invalid number of xattr blocks at offset 0x{xattrs_block_start:X} "
-                          f"of inode {self.inode_idx:d}: {xattrs_header.h_blocks:d} (expected 1)")
-                    return '', ''
-
-            offset = 4 * ((ctypes.sizeof(
-                ext4_xattr_header) + 3) // 4)
-            # The ext4_xattr_entry following the header is aligned on a 4-byte boundary
-            for xattr_name, xattr_value in self._parse_xattrs(xattrs_block[offset:], -offset):
-                yield xattr_name, xattr_value
+            xattrs = self.volume.xattr_blocks.get(self.inode.i_file_acl)
+            if xattrs is None:
+                xattrs = self.volume.xattr_blocks[self.inode.i_file_acl] = list(self._block_xattrs())
+            yield from xattrs
+
+    def _block_xattrs(self):
+        xattrs_block_start = self.inode.i_file_acl * self.volume.block_size
+        xattrs_block = self.volume.read(xattrs_block_start, self.volume.block_size)
+        if xattrs_block:
+            xattrs_header = ext4_xattr_header.from_buffer_copy(xattrs_block)
+            if not self.volume.ignore_magic and xattrs_header.h_magic != 0xEA020000:
+                # Perhaps you think this code is a bit foolish, but that's all others can do
+                print(f"Invalid magic value in xattrs block header at offset 0x{xattrs_block_start:X} of "
+                      f"inode {self.inode_idx:d}: 0x{xattrs_header.h_magic} (expected 0xEA020000)")
+                return '', ''
+
+            if xattrs_header.h_blocks != 1:
+                print(f"Invalid number of xattr blocks at offset 0x{xattrs_block_start:X} "
+                      f"of inode {self.inode_idx:d}: {xattrs_header.h_blocks:d} (expected 1)")
+                return '', ''
+
+        offset = 4 * ((ctypes.sizeof(
+            ext4_xattr_header) + 3) // 4)
+        # The ext4_xattr_entry following the header is aligned on a 4-byte boundary
+        for xattr_name, xattr_value in self._parse_xattrs(xattrs_block[offset:], -offset):
+            yield xattr_name, xattr_value
 
 
 class BlockReader:
@@ -887,21 +1190,46 @@ class BlockReader:
         # Optimize mapping (stich together)
         MappingEntry.optimize(block_map)
         self.block_map = block_map
+        # Sorted first file blocks of block_map, searched with bisect
+        self.block_index = [entry.file_block_idx for entry in block_map]
 
     def __repr__(self):
         return f"{type(self).__name__:s}(byte_size = {self.byte_size!r:s}, block_map = {self.block_map!r:s}, volume_uuid = {self.volume.uuid!r:s})"
 
     def get_block_mapping(self, file_block_idx):
-        disk_block_idx = None
-
-        # Find disk block
-        for entry in self.block_map:
-            if entry.file_block_idx <= file_block_idx < entry.file_block_idx + entry.block_count:
-                block_diff = file_block_idx - entry.file_block_idx
-                disk_block_idx = entry.disk_block_idx + block_diff
-                break
-
-        return disk_block_idx
+        idx = bisect_right(self.block_index, file_block_idx) - 1
+        if idx >= 0:
+            entry = self.block_map[idx]
+            if file_block_idx < entry.file_block_idx + entry.block_count:
+                return entry.disk_block_idx + file_block_idx - entry.file_block_idx
+        return None
+
+    def get_byte_runs(self, offset, byte_len):
+        """
+        Yield (disk offset, length) runs covering byte_len bytes of the file from offset.
+        Each run of contiguous disk blocks is one item, holes have a disk offset of None.
+        """
+        block_size = self.volume.block_size
+        end = offset + byte_len
+        idx = max(bisect_right(self.block_index, offset // block_size) - 1, 0)
+        while offset < end:
+            if idx >= len(self.block_map):
+                yield None, end - offset
+                return
+            entry = self.block_map[idx]
+            entry_start = entry.file_block_idx * block_size
+            entry_end = entry_start + entry.block_count * block_size
+            if offset < entry_start:
+                length = min(end, entry_start) - offset
+                yield None, length
+            elif offset < entry_end:
+                length = min(end, entry_end) - offset
+                yield entry.disk_block_idx * block_size + offset - entry_start, length
+                idx += 1
+            else:
+                idx += 1
+                continue
+            offset += length
 
     def read(self, byte_len=-1):
         # Parse args
@@ -914,35 +1242,119 @@ class BlockReader:
         if byte_len == 0:
             return b""
 
-        # Reading blocks
-        start_block_idx = self.cursor // self.volume.block_size
-        end_block_idx = (self.cursor + byte_len - 1) // self.volume.block_size
+        # Reading runs of contiguous blocks
         end_of_stream_check = byte_len
-
-        blocks = [self.read_block(i) for i in range(start_block_idx, end_block_idx - start_block_idx + 1)]
-
-        start_offset = self.cursor % self.volume.block_size
-        if start_offset != 0:
-            blocks[0] = blocks[0][start_offset:]
-        byte_len = (byte_len + start_offset - self.volume.block_size - 1) % self.volume.block_size + 1
-        blocks[-1] = blocks[-1][:byte_len]
-
-        result = b"".join(blocks)
+        chunks = [bytes(length) if disk_offset is None else self.volume.read(disk_offset, length)
+                  for disk_offset, length in self.get_byte_runs(self.cursor, byte_len)]
+        result = chunks[0] if len(chunks) == 1 else b"".join(chunks)
 
         # Check read
         if len(result) != end_of_stream_check:
-            raise EndOfStreamError(f"The volume's underlying stream ended {byte_len - len(result):d} bytes before EOF.")
+            raise EndOfStreamError(
+                f"The volume's underlying stream ended {end_of_stream_check - len(result):d} bytes before EOF.")
 
         self.cursor += len(result)
         return result
 
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        byte_len = max(0, min(len(view), self.byte_size - self.cursor))
+        pos = 0
+        for disk_offset, length in self.get_byte_runs(self.cursor, byte_len):
+            if disk_offset is None:
+                view[pos:pos + length] = bytes(length)
+            elif self.volume.readinto(disk_offset, view[pos:pos + length]) != length:
+                raise EndOfStreamError("The volume's underlying stream ended before EOF.")
+            pos += length
+        self.cursor += pos
+        return pos
+
+    def iter_chunks(self, chunk_size=1048576):
+        """
+        Yield the rest of the file in chunks of at most chunk_size bytes.
+        """
+        while chunk := self.read(chunk_size):
+            yield chunk
+
+    def copy_to(self, out_file, buffsize=1048576, sparse=False):
+        """
+        Copy the rest of the file to out_file without holding more than buffsize bytes in memory.
+        Mapped runs are copied with os.copy_file_range straight from the image when both sides are real files.
+        :param sparse: seek over holes instead of writing zeros and extend out_file to the end at last, so a
+                       new file keeps the holes. out_file must read as zeros past its position.
+        Returns the number of bytes copied.
+        """
+        in_fd = self.volume.fileno() if hasattr(os, 'copy_file_range') else None
+        out_fd = None
+        position = 0
+        if in_fd is not None or sparse:
+            try:
+                out_fd = out_file.fileno()
+                out_file.flush()
+                position = out_file.tell()
+            except (AttributeError, OSError, ValueError):
+                in_fd = None
+                try:
+                    sparse = sparse and out_file.seekable()
+                except (AttributeError, OSError, ValueError):
+                    sparse = False
+                if sparse:
+                    position = out_file.tell()
+        skipped = False
+        copied = 0
+        for disk_offset, length in self.get_byte_runs(self.cursor, self.byte_size - self.cursor):
+            if sparse and disk_offset is None:
+                position += length
+                copied += length
+                skipped = True
+                continue
+            if skipped and in_fd is None:
+                out_file.seek(position)
+            skipped = False
+            while length:
+                if in_fd is not None and disk_offset is not None:
+                    try:
+                        n = os.copy_file_range(in_fd, out_fd, min(length, 1073741824),
+                                               self.volume.offset + disk_offset, position)
+                    except OSError:
+                        # Not supported between these files, copy through the buffer from now on
+                        in_fd = None
+                        out_file.seek(position)
+                        continue
+                    if not n:
+                        raise EndOfStreamError(f"The volume's underlying stream ended {length:d} bytes early.")
+                else:
+                    n = min(length, buffsize)
+                    data = bytes(n) if disk_offset is None else self.volume.read(disk_offset, n)
+                    if len(data) != n:
+                        raise EndOfStreamError(f"The volume's underlying stream ended {n - len(data):d} bytes early.")
+                    if in_fd is not None:
+                        os.pwrite(out_fd, data, position)
+                    else:
+                        out_file.write(data)
+                length -= n
+                position += n
+                copied += n
+                if disk_offset is not None:
+                    disk_offset += n
+        if skipped and out_file.seek(0, io.SEEK_END) < position:
+            # The file ends with a hole, truncate does not extend every kind of file
+            out_file.truncate(position)
+            if out_file.seek(0, io.SEEK_END) < position:
+                out_file.seek(position - 1)
+                out_file.write(b'\0')
+        if in_fd is not None or skipped:
+            out_file.seek(position)
+        self.cursor += copied
+        return copied
+
     def read_block(self, file_block_idx):
         disk_block_idx = self.get_block_mapping(file_block_idx)
 
         if disk_block_idx is not None:
             return self.volume.read(disk_block_idx * self.volume.block_size, self.volume.block_size)
         else:
-            return bytes([0] * self.volume.block_size)
+            return bytes(self.volume.block_size)
 
     def seek(self, seek, seek_mode=io.SEEK_SET):
         if seek_mode == io.SEEK_CUR:
@@ -0,0 +1,751 @@
+# Copyright (C) 2022-2025 The MIO-KITCHEN-SOURCE Project
+#
+# Licensed under the GNU AFFERO GENERAL PUBLIC LICENSE, Version 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.gnu.org/licenses/agpl-3.0.en.html#license-text
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Build an ext4 image from an unpacked directory without make_ext4fs or mke2fs.
+Owners, modes and capabilities come from fs_config and SELinux labels from file_contexts, as with make_ext4fs.
+The whole layout is planned first, so the image is only as large as its content needs, then it is written front
+to back in one pass, raw or as an Android sparse image.
+The image has no journal and no checksums, like the ones mke2fs makes for the packer.
+"""
+import errno
+import os
+import re
+import stat
+import struct
+import time
+import uuid
+
+from . import ext4
+from .fspatch import scanfs
+from .posix import readlink
+from .sparse_img import SparseWriter
+
+BLOCK_SIZE = 4096
+BLOCKS_PER_GROUP = BLOCK_SIZE * 8
+INODE_SIZE = 256
+INODES_PER_BLOCK = BLOCK_SIZE // INODE_SIZE
+EXTRA_ISIZE = 32
+DESC_SIZE = 32
+ROOT_INO = 2
+LOST_FOUND_INO = 11
+# In-inode xattrs live between the extra fields and the end of the inode
+XATTR_IBODY = ext4.ext4_inode.EXT2_GOOD_OLD_INODE_SIZE + EXTRA_ISIZE
+XATTR_MAGIC = 0xEA020000
+XATTR_INDEX_SECURITY = 6
+EXTENT_MAGIC = 0xF30A
+INODE_EXTENTS = 4
+LEAF_EXTENTS = (BLOCK_SIZE - 12) // 12
+MAX_EXTENT_LEN = ext4.ext4_extent.EXT_INIT_MAX_LEN
+# Symlink targets shorter than this are stored in i_block
+FAST_SYMLINK = 60
+
+COMPAT_EXT_ATTR = 0x8
+INCOMPAT_FILETYPE = 0x2
+INCOMPAT_EXTENTS = 0x40
+RO_COMPAT_SPARSE_SUPER = 0x1
+RO_COMPAT_LARGE_FILE = 0x2
+RO_COMPAT_HUGE_FILE = 0x8
+RO_COMPAT_DIR_NLINK = 0x20
+RO_COMPAT_EXTRA_ISIZE = 0x40
+EXT4_DIR_LINK_MAX = 65000
+FILE_TYPES = {stat.S_IFREG: 1, stat.S_IFDIR: 2, stat.S_IFLNK: 7}
+
+
+def has_super(group):
+    """
+    Whether a group holds a superblock backup with sparse_super: 0, 1 and the powers of 3, 5 and 7.
+    """
+    if group < 2:
+        return True
+    for base in (3, 5, 7):
+        power = base
+        while power < group:
+            power *= base
+        if power == group:
+            return True
+    return False
+
+
+def xattr_hash(name: bytes, value: bytes) -> int:
+    """
+    ext4_xattr_hash_entry, names are ASCII so the signedness of char does not matter.
+    """
+    value_hash = 0
+    for char in name:
+        value_hash = (value_hash << 5 ^ value_hash >> 27 ^ char) & 0xFFFFFFFF
+    value += bytes(-len(value) % 4)
+    for word in struct.unpack(f'<{len(value) // 4}I', value):
+        value_hash = (value_hash << 16 ^ value_hash >> 16 ^ word) & 0xFFFFFFFF
+    return value_hash
+
+
+def pack_xattrs(xattrs, size, value_base=0):
+    """
+    Pack the (name index, name, value) entries sorted as the kernel keeps them, with the values at the end of size
+    bytes. Returns the packed bytes and their entry hashes, None when they do not fit.
+    :param value_base: where the entries start, value offsets are relative to value_base bytes before them
+    """
+    xattrs = sorted(xattrs, key=lambda i: (i[0], len(i[1]), i[1]))
+    hashes = [xattr_hash(name, value) for _, name, value in xattrs]
+    entries_size = sum(16 + len(name) + -len(name) % 4 for _, name, _ in xattrs)
+    if entries_size + 4 + sum(len(value) + -len(value) % 4 for _, _, value in xattrs) > size:
+        return None, hashes
+    entries = b''
+    values = b''
+    for (index, name, value), entry_hash in zip(xattrs, hashes):
+        values = value + bytes(-len(value) % 4) + values
+        entries += struct.pack('<BBHIII', len(name), index, value_base + size - len(values), 0, len(value),
+                               entry_hash) + name + bytes(-len(name) % 4)
+    return entries + bytes(size - len(entries) - len(values)) + values, hashes
+
+
+class FileContexts:
+    """
+    SELinux labels from a file_contexts file. Plain paths win over regular expressions and among the expressions
+    the last matching line wins, as in libselinux.
+    """
+    _types = {'--': stat.S_IFREG, '-d': stat.S_IFDIR, '-l': stat.S_IFLNK, '-b': stat.S_IFBLK, '-c': stat.S_IFCHR,
+              '-p': stat.S_IFIFO, '-s': stat.S_IFSOCK}
+    _meta = '.^$?*+|[({'
+
+    def __init__(self, file):
+        self.plain = {}
+        # (literal prefix, compiled expression, file type, label)
+        self.specs = []
+        with open(file, encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2 or fields[0].startswith('#'):
+                    continue
+                expression, label = fields[0], fields[-1]
+                file_type = FileContexts._types.get(fields[1]) if len(fields) > 2 else None
+                label = None if label == '<<none>>' else label
+                stem, plain = self.__stem(expression)
+                if plain:
+                    self.plain.setdefault(stem, []).append((file_type, label))
+                else:
+                    try:
+                        self.specs.append((stem, re.compile(expression), file_type, label))
+                    except re.error:
+                        print(f"[W] Skip invalid file_contexts line {line.strip()}")
+
+    @staticmethod
+    def __stem(expression):
+        stem = []
+        escaped = False
+        for char in expression:
+            if escaped:
+                stem.append(char)
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char in FileContexts._meta:
+                if '|' in expression:
+                    return '', False
+                # A quantifier makes the character before it optional
+                return ''.join(stem[:-1] if char in '?*{' else stem), False
+            else:
+                stem.append(char)
+        return ''.join(stem), True
+
+    def lookup(self, path, file_type):
+        for spec_type, label in reversed(self.plain.get(path, ())):
+            if spec_type is None or spec_type == file_type:
+                return label
+        for stem, expression, spec_type, label in reversed(self.specs):
+            if path.startswith(stem) and (spec_type is None or spec_type == file_type) and expression.fullmatch(
+                    path):
+                return label
+        return None
+
+
+class _Node:
+    __slots__ = ('path', 'rel', 'mode', 'parent', 'ino', 'uid', 'gid', 'capabilities', 'label', 'size', 'links',
+                 'subdirs', 'children', 'runs', 'data', 'extents', 'leaves', 'blocks', 'xattrs', 'xattr_key')
+
+    def __init__(self, path, rel, mode, parent=None):
+        self.path = path
+        self.rel = rel
+        self.mode = mode
+        self.parent = parent
+        self.ino = 0
+        self.uid = self.gid = self.capabilities = self.size = self.subdirs = 0
+        self.label = None
+        self.links = 1
+        # (name, node) entries of a directory
+        self.children = []
+        # Logical (first block, block count) runs holding data
+        self.runs = []
+        # Content of directory and symlink blocks, file data is read from path
+        self.data = b''
+        # (logical block, physical block, length)
+        self.extents = []
+        self.leaves = []
+        # Blocks counted in i_blocks: data, extent leaves and the xattr block
+        self.blocks = 0
+        self.xattrs = []
+        # Key of the shared xattr block when the xattrs do not fit in the inode
+        self.xattr_key = None
+
+
+def data_runs(path, size, st):
+    """
+    Logical (first block, block count) runs of a file holding data, holes are left out where the host reports them.
+    """
+    blocks = -(-size // BLOCK_SIZE)
+    if not blocks:
+        return []
+    if not hasattr(os, 'SEEK_DATA') or getattr(st, 'st_blocks', blocks * 8) * 512 >= size:
+        return [(0, blocks)]
+    runs = []
+    with open(path, 'rb') as f:
+        offset = 0
+        try:
+            while offset < size:
+                data = os.lseek(f.fileno(), offset, os.SEEK_DATA)
+                offset = min(os.lseek(f.fileno(), data, os.SEEK_HOLE), size)
+                start, end = data // BLOCK_SIZE, -(-offset // BLOCK_SIZE)
+                if runs and runs[-1][0] + runs[-1][1] >= start:
+                    runs[-1] = (runs[-1][0], end - runs[-1][0])
+                elif end > start:
+                    runs.append((start, end - start))
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                return [(0, blocks)]
+    return runs
+
+
+def bitmap(used, valid):
+    """
+    One bitmap block with the first used bits set, and the padding bits from valid on.
+    """
+    bits = bytearray(BLOCK_SIZE)
+    bits[:used // 8] = b'\xff' * (used // 8)
+    if used % 8:
+        bits[used // 8] = (1 << used % 8) - 1
+    if valid < BLOCK_SIZE * 8:
+        if valid % 8:
+            bits[valid // 8] |= 0xFF ^ ((1 << valid % 8) - 1)
+        start = -(-valid // 8)
+        bits[start:] = b'\xff' * (BLOCK_SIZE - start)
+    return bytes(bits)
+
+
+class Ext4Builder:
+    """
+    :param source_dir: unpacked directory of the partition
+    :param name: partition name, the volume label and the prefix of fs_config paths
+    :param fs_config: fs_config file, paths missing from it keep their host mode and belong to root
+    :param file_contexts: file_contexts file, None leaves the files unlabelled
+    :param mount_point: where the image is mounted, file_contexts paths are looked up under it
+    :param hardlinks: <name>_hardlinks.txt of the extractor, the names in it become hard links again
+    :param timestamp: time of every inode, now by default
+    :param size: size of the image in bytes, 0 for the smallest image holding everything
+    :param fs_uuid: filesystem UUID like mke2fs -U, by default derived from name and timestamp so the same
+                    input builds the same image
+    """
+
+    def __init__(self, source_dir, name, fs_config=None, file_contexts=None, mount_point=None, hardlinks=None,
+                 timestamp=None, size=0, fs_uuid=None):
+        self.source_dir = source_dir
+        self.name = name
+        self.mount_point = mount_point or f'/{name}'
+        self.fs_config = scanfs(fs_config) if fs_config and os.path.exists(fs_config) else {}
+        self.contexts = FileContexts(file_contexts) if file_contexts and os.path.exists(file_contexts) else None
+        self.hardlinks = {}
+        if hardlinks and os.path.exists(hardlinks):
+            with open(hardlinks, encoding='utf-8') as f:
+                for line in f:
+                    if len(fields := line.split()) == 2:
+                        self.hardlinks[fields[0]] = fields[1]
+        self.timestamp = int(time.time()) if timestamp is None else int(timestamp)
+        self.size = size
+        if fs_uuid is None:
+            self.uuid = uuid.uuid5(uuid.NAMESPACE_OID, f'{name}:{self.timestamp}')
+        else:
+            self.uuid = fs_uuid if isinstance(fs_uuid, uuid.UUID) else uuid.UUID(fs_uuid)
+        # Every inode, by inode number
+        self.nodes = []
+        # xattr entries -> [block, reference count] of the inodes whose xattrs do not fit in the inode
+        self.xattr_blocks = {}
+        self.blocks_count = self.groups = self.inodes_per_group = 0
+
+    def __config(self, rel):
+        if not rel:
+            return self.fs_config.get(self.name) or self.fs_config.get('/')
+        for key in (f'{self.name}/{rel}', f'/{rel}', rel):
+            if key in self.fs_config:
+                return self.fs_config[key]
+        return None
+
+    def __set_attributes(self, node, host_mode):
+        node.mode = stat.S_IFMT(node.mode) | host_mode
+        config = self.__config(node.rel)
+        if config and len(config) >= 3:
+            try:
+                node.uid, node.gid = int(config[0]), int(config[1])
+                node.mode = stat.S_IFMT(node.mode) | int(config[2], 8) & 0o7777
+            except ValueError:
+                print(f"[W] Bad fs_config entry of {node.rel or '/'}")
+            for field in config[3:]:
+                if field.startswith('capabilities='):
+                    node.capabilities = int(field[13:], 0)
+        if self.contexts:
+            path = f"{self.mount_point.rstrip('/')}/{node.rel}" if node.rel else self.mount_point
+            node.label = self.contexts.lookup(path, stat.S_IFMT(node.mode))
+        if node.label:
+            node.xattrs.append((XATTR_INDEX_SECURITY, b'selinux', node.label.encode('utf-8') + b'\0'))
+        if node.capabilities and stat.S_ISREG(node.mode):
+            # vfs_cap_data revision 2 with the effective bit, as make_ext4fs writes it
+            node.xattrs.append((XATTR_INDEX_SECURITY, b'capability', struct.pack(
+                '<5I', 0x02000001, node.capabilities & 0xFFFFFFFF, 0, node.capabilities >> 32, 0)))
+
+    def scan(self):
+        """
+        Walk source_dir and number the inodes, the directories first. Hard links share the inode of their first name,
+        and its fs_config entry.
+        """
+        root = _Node(self.source_dir, '', stat.S_IFDIR)
+        root.parent = root
+        root.ino = ROOT_INO
+        self.__set_attributes(root, stat.S_IMODE(os.stat(self.source_dir).st_mode))
+        lost_found = None
+        files = []
+        # Keys of the inodes with more than one name, a host inode or a path of the hardlinks record
+        first_names = {}
+        directories = [root]
+        for directory in directories:
+            with os.scandir(directory.path) as it:
+                entries = sorted(it, key=lambda i: i.name)
+            for entry in entries:
+                rel = f'{directory.rel}/{entry.name}' if directory.rel else entry.name
+                st = entry.stat(follow_symlinks=False)
+                if entry.is_symlink():
+                    link_target = os.readlink(entry.path)
+                elif os.name == 'nt' and entry.is_file() and st.st_size < 4096:
+                    link_target = readlink(entry.path)
+                else:
+                    link_target = ''
+                if link_target:
+                    node = _Node(entry.path, rel, stat.S_IFLNK, directory)
+                    node.data = link_target.encode('utf-8')
+                    node.size = len(node.data)
+                    if node.size >= FAST_SYMLINK:
+                        node.runs = [(0, 1)]
+                    files.append(node)
+                elif entry.is_dir(follow_symlinks=False):
+                    node = _Node(entry.path, rel, stat.S_IFDIR, directory)
+                    directory.subdirs += 1
+                    if directory is root and entry.name == 'lost+found':
+                        lost_found = node
+                    directories.append(node)
+                elif entry.is_file(follow_symlinks=False):
+                    keys = [f'{self.name}/{rel}']
+                    if keys[0] in self.hardlinks:
+                        keys.append(self.hardlinks[keys[0]])
+                    if st.st_nlink > 1:
+                        keys.append((st.st_dev, st.st_ino))
+                    first = next((first_names[i] for i in keys if i in first_names), None)
+                    if first:
+                        if self.__config(rel) != self.__config(first.rel):
+                            print(f"[W] {rel} is a hard link of {first.rel} with another fs_config entry, "
+                                  f"the one of {first.rel} is used")
+                        first.links += 1
+                        for key in keys:
+                            first_names.setdefault(key, first)
+                        directory.children.append((entry.name, first))
+                        continue
+                    node = _Node(entry.path, rel, stat.S_IFREG, directory)
+                    node.size = st.st_size
+                    node.runs = data_runs(entry.path, node.size, st)
+                    for key in keys:
+                        first_names[key] = node
+                    files.append(node)
+                else:
+                    print(f"[W] Skip {rel}, only files, directories and symlinks are supported")
+                    continue
+                self.__set_attributes(node, stat.S_IMODE(st.st_mode))
+                directory.children.append((entry.name, node))
+        if lost_found is None:
+            lost_found = _Node(None, 'lost+found', stat.S_IFDIR, root)
+            self.__set_attributes(lost_found, 0o700)
+            root.children.append(('lost+found', lost_found))
+            root.subdirs += 1
+            directories.append(lost_found)
+        lost_found.ino = LOST_FOUND_INO
+        ino = LOST_FOUND_INO
+        for node in directories[1:] + files:
+            if node is not lost_found:
+                ino += 1
+                node.ino = ino
+        self.nodes = sorted(directories + files, key=lambda i: i.ino)
+        for node in directories:
+            node.links = 2 + node.subdirs if 2 + node.subdirs < EXT4_DIR_LINK_MAX else 1
+            node.data = self.__dir_blocks(node)
+            node.size = len(node.data)
+            node.runs = [(0, node.size // BLOCK_SIZE)]
+        return ino
+
+    @staticmethod
+    def __dir_blocks(node):
+        """
+        Linear directory blocks, the last entry of every block runs to its end.
+        """
+        blocks = []
+        block = []
+        used = 0
+        for name, child in [('.', node), ('..', node.parent)] + node.children:
+            name = name.encode('utf-8')
+            if len(name) > 255:
+                raise ValueError(f"Name too long in {node.rel or '/'}: {name.decode('utf-8')}")
+            entry = struct.pack('<IHBB', child.ino, 8 + len(name) + -len(name) % 4, len(name),
+                                FILE_TYPES[stat.S_IFMT(child.mode)]) + name + bytes(-len(name) % 4)
+            if used + len(entry) > BLOCK_SIZE:
+                blocks.append(block)
+                block = []
+                used = 0
+            block.append(entry)
+            used += len(entry)
+        blocks.append(block)
+        data = bytearray()
+        for block in blocks:
+            last = block.pop()
+            block.append(last[:4] + struct.pack('<H', BLOCK_SIZE - sum(len(i) for i in block)) + last[6:])
+            data += b''.join(block)
+            data += bytes(-len(data) % BLOCK_SIZE)
+        return bytes(data)
+
+    @staticmethod
+    def __overhead(group, groups, inodes_per_group):
+        """
+        Blocks at the start of a group: superblock and descriptors where backed up, both bitmaps and the inode table.
+        """
+        descriptor_blocks = -(-groups * DESC_SIZE // BLOCK_SIZE)
+        return (1 + descriptor_blocks if has_super(group) else 0) + 2 + inodes_per_group // INODES_PER_BLOCK
+
+    def plan(self, last_ino):
+        """
+        Size the filesystem for the scanned inodes, sets blocks_count, groups and inodes_per_group.
+        """
+        data_blocks = 0
+        for node in self.nodes:
+            if node.xattrs and pack_xattrs(node.xattrs, INODE_SIZE - XATTR_IBODY - 4)[0] is None:
+                node.xattr_key = tuple(node.xattrs)
+                if node.xattr_key not in self.xattr_blocks:
+                    self.xattr_blocks[node.xattr_key] = [0, 0]
+                    data_blocks += 1
+                self.xattr_blocks[node.xattr_key][1] += 1
+            blocks = sum(count for _, count in node.runs)
+            # Runs get split at the metadata of every group they cross, count the leaves of the worst case
+            extents = len(node.runs) + blocks // (BLOCKS_PER_GROUP // 2) + 1
+            data_blocks += blocks + (-(-extents // LEAF_EXTENTS) if extents > INODE_EXTENTS else 0)
+
+        def inodes_per_group(inodes, groups):
+            return -(-inodes // (groups * INODES_PER_BLOCK)) * INODES_PER_BLOCK
+
+        if self.size:
+            blocks_count = self.size // BLOCK_SIZE
+            groups = -(-blocks_count // BLOCKS_PER_GROUP)
+            # One inode per 16 KiB as mke2fs makes, the image may be mounted read-write
+            ipg = min(inodes_per_group(max(last_ino, blocks_count * BLOCK_SIZE // 16384), groups), BLOCKS_PER_GROUP)
+            if groups > 1 and blocks_count - (groups - 1) * BLOCKS_PER_GROUP <= self.__overhead(groups - 1, groups,
+                                                                                                ipg):
+                # A last group too small for its own metadata is dropped, as mke2fs does
+                groups -= 1
+                blocks_count = groups * BLOCKS_PER_GROUP
+            overhead = sum(self.__overhead(i, groups, ipg) for i in range(groups))
+            if overhead + data_blocks > blocks_count or ipg * groups < last_ino:
+                raise ValueError(f"{self.name} does not fit in {self.size} bytes")
+        else:
+            groups = max(1, data_blocks // BLOCKS_PER_GROUP)
+            while True:
+                ipg = inodes_per_group(last_ino, groups)
+                if ipg <= BLOCKS_PER_GROUP:
+                    overhead = [self.__overhead(i, groups, ipg) for i in range(groups)]
+                    # Data the groups before the last one hold
+                    capacity = (groups - 1) * BLOCKS_PER_GROUP - sum(overhead[:-1])
+                    if capacity + BLOCKS_PER_GROUP - overhead[-1] >= data_blocks:
+                        blocks_count = (groups - 1) * BLOCKS_PER_GROUP + overhead[-1] + max(data_blocks - capacity, 0)
+                        break
+                groups += 1
+        self.blocks_count, self.groups, self.inodes_per_group = blocks_count, groups, ipg
+
+    def allocate(self):
+        """
+        Give every inode its blocks, in inode order from the start of the image.
+        Without a fixed size the image is cut right after the last block in use.
+        """
+        regions = []
+        for group in range(self.groups):
+            start = group * BLOCKS_PER_GROUP
+            regions.append([start + self.__overhead(group, self.groups, self.inodes_per_group),
+                            min(start + BLOCKS_PER_GROUP, self.blocks_count)])
+        region = 0
+
+        def alloc(count):
+            nonlocal region
+            runs = []
+            while count:
+                if region >= len(regions):
+                    raise ValueError(f"{self.name} ran out of blocks")
+                start, end = regions[region]
+                length = min(count, end - start)
+                if length:
+                    runs.append((start, length))
+                    regions[region][0] += length
+                    count -= length
+                else:
+                    region += 1
+            return runs
+
+        for node in self.nodes:
+            if node.xattr_key:
+                entry = self.xattr_blocks[node.xattr_key]
+                if not entry[0]:
+                    entry[0] = alloc(1)[0][0]
+                node.blocks += 1
+            for logical, count in node.runs:
+                for physical, length in alloc(count):
+                    while length:
+                        extent_len = min(length, MAX_EXTENT_LEN)
+                        node.extents.append((logical, physical, extent_len))
+                        logical += extent_len
+                        physical += extent_len
+                        length -= extent_len
+                node.blocks += count
+            if len(node.extents) > INODE_EXTENTS:
+                leaves = -(-len(node.extents) // LEAF_EXTENTS)
+                if leaves > INODE_EXTENTS:
+                    raise ValueError(f"{node.rel} is too fragmented")
+                for physical, length in alloc(leaves):
+                    node.leaves.extend(range(physical, physical + length))
+                node.blocks += leaves
+        if not self.size:
+            # The last group keeps at least its own metadata
+            self.blocks_count = max(regions[region][0], regions[-1][0])
+        # Blocks given out in every group
+        return [regions[group][0] - group * BLOCKS_PER_GROUP for group in range(self.groups)]
+
+    def __inode(self, node):
+        inode = ext4.ext4_inode()
+        inode.i_mode = node.mode
+        inode.i_uid = node.uid
+        inode.i_gid = node.gid
+        inode.i_size = node.size
+        inode.i_atime = inode.i_ctime = inode.i_mtime = inode.i_crtime = self.timestamp
+        inode.i_links_count = node.links
+        inode.i_blocks_lo = node.blocks * (BLOCK_SIZE // 512) & 0xFFFFFFFF
+        inode.i_osd2_blocks_high = node.blocks * (BLOCK_SIZE // 512) >> 32
+        inode.i_extra_isize = EXTRA_ISIZE
+        if stat.S_ISLNK(node.mode) and not node.runs:
+            i_block = node.data
+        else:
+            inode.i_flags = ext4.ext4_inode.EXT4_EXTENTS_FL
+            if node.leaves:
+                entries = [struct.pack('<IIHH', node.extents[i * LEAF_EXTENTS][0], leaf, 0, 0)
+                           for i, leaf in enumerate(node.leaves)]
+                depth = 1
+            else:
+                entries = [struct.pack('<IHHI', logical, length, physical >> 32, physical & 0xFFFFFFFF)
+                           for logical, physical, length in node.extents]
+                depth = 0
+            i_block = struct.pack('<4HI', EXTENT_MAGIC, len(entries), INODE_EXTENTS, depth, 0) + b''.join(entries)
+        xattrs = b''
+        if node.xattr_key:
+            inode.i_file_acl = self.xattr_blocks[node.xattr_key][0]
+        elif node.xattrs:
+            xattrs = struct.pack('<I', XATTR_MAGIC) + pack_xattrs(node.xattrs, INODE_SIZE - XATTR_IBODY - 4)[0]
+        raw = bytearray(bytes(inode))
+        offset = ext4.ext4_inode.i_block.offset
+        raw[offset:offset + len(i_block)] = i_block
+        return bytes(raw) + xattrs + bytes(INODE_SIZE - len(raw) - len(xattrs))
+
+    def __leaves(self, node):
+        for i, leaf in enumerate(node.leaves):
+            extents = node.extents[i * LEAF_EXTENTS:(i + 1) * LEAF_EXTENTS]
+            block = struct.pack('<4HI', EXTENT_MAGIC, len(extents), LEAF_EXTENTS, 0, 0) + b''.join(
+                struct.pack('<IHHI', logical, length, physical >> 32, physical & 0xFFFFFFFF)
+                for logical, physical, length in extents)
+            yield leaf, block + bytes(BLOCK_SIZE - len(block))
+
+    @staticmethod
+    def __xattr_block(xattrs, refcount):
+        packed, hashes = pack_xattrs(xattrs, BLOCK_SIZE - 32, 32)
+        if packed is None:
+            raise ValueError(f"Extended attributes do not fit in one block: {xattrs}")
+        block_hash = 0
+        for entry_hash in hashes:
+            block_hash = (block_hash << 16 ^ block_hash >> 16 ^ entry_hash) & 0xFFFFFFFF
+        return struct.pack('<8I', XATTR_MAGIC, refcount, 1, block_hash, 0, 0, 0, 0) + packed
+
+    def __superblock(self, group, free_blocks, free_inodes):
+        sb = ext4.ext4_superblock()
+        sb.s_inodes_count = self.inodes_per_group * self.groups
+        sb.s_blocks_count = self.blocks_count
+        sb.s_free_blocks_count = free_blocks
+        sb.s_free_inodes_count = free_inodes
+        sb.s_log_block_size = sb.s_log_cluster_size = BLOCK_SIZE.bit_length() - 11
+        sb.s_blocks_per_group = sb.s_clusters_per_group = BLOCKS_PER_GROUP
+        sb.s_inodes_per_group = self.inodes_per_group
+        sb.s_wtime = sb.s_lastcheck = sb.s_mkfs_time = self.timestamp
+        sb.s_max_mnt_count = 0xFFFF
+        sb.s_magic = 0xEF53
+        sb.s_state = 1
+        sb.s_errors = 1
+        sb.s_rev_level = 1
+        sb.s_first_ino = LOST_FOUND_INO
+        sb.s_inode_size = INODE_SIZE
+        sb.s_block_group_nr = group
+        sb.s_feature_compat = COMPAT_EXT_ATTR
+        sb.s_feature_incompat = INCOMPAT_FILETYPE | INCOMPAT_EXTENTS
+        sb.s_feature_ro_compat = RO_COMPAT_SPARSE_SUPER | RO_COMPAT_LARGE_FILE | RO_COMPAT_HUGE_FILE | \
+                                 RO_COMPAT_DIR_NLINK | RO_COMPAT_EXTRA_ISIZE
+        sb.s_uuid[:] = self.uuid.bytes
+        sb.s_volume_name = self.name.encode('utf-8')[:16]
+        sb.s_last_mounted = self.mount_point.encode('utf-8')[:64]
+        sb.s_hash_seed[:] = struct.unpack('<4I', uuid.uuid5(self.uuid, 'hash_seed').bytes)
+        sb.s_def_hash_version = ext4.DX_HASH_HALF_MD4
+        sb.s_min_extra_isize = sb.s_want_extra_isize = EXTRA_ISIZE
+        sb.s_flags = ext4.EXT2_FLAGS_UNSIGNED_HASH
+        return bytes(sb)
+
+    def metadata(self, allocated, last_ino):
+        """
+        Yield (first block, block count, data) of the superblocks, descriptors, bitmaps and inode tables,
+        data is None for blocks that must read as zeros.
+        """
+        ipg = self.inodes_per_group
+        used_dirs = [0] * self.groups
+        for node in self.nodes:
+            if stat.S_ISDIR(node.mode):
+                used_dirs[(node.ino - 1) // ipg] += 1
+        descriptors = bytearray()
+        layout = []
+        for group in range(self.groups):
+            start = group * BLOCKS_PER_GROUP
+            length = min(BLOCKS_PER_GROUP, self.blocks_count - start)
+            block_bitmap = start + self.__overhead(group, self.groups, 0) - 2
+            used_inodes = min(max(last_ino - group * ipg, 0), ipg)
+            layout.append((start, length, block_bitmap, used_inodes))
+            descriptor = ext4.ext4_group_descriptor()
+            descriptor.bg_block_bitmap = block_bitmap
+            descriptor.bg_inode_bitmap = block_bitmap + 1
+            descriptor.bg_inode_table = block_bitmap + 2
+            descriptor.bg_free_blocks_count = length - allocated[group]
+            descriptor.bg_free_inodes_count = ipg - used_inodes
+            descriptor.bg_used_dirs_count = used_dirs[group]
+            descriptors += bytes(descriptor)[:DESC_SIZE]
+        descriptors += bytes(-len(descriptors) % BLOCK_SIZE)
+        free_blocks = self.blocks_count - sum(allocated)
+        free_inodes = ipg * self.groups - last_ino
+        by_ino = {node.ino: node for node in self.nodes}
+        for group, (start, length, block_bitmap, used_inodes) in enumerate(layout):
+            if has_super(group):
+                superblock = self.__superblock(group, free_blocks, free_inodes)
+                # The primary superblock sits 1024 bytes into block 0, the backups at the start of their block
+                padding = 1024 if group == 0 else 0
+                yield start, 1, bytes(padding) + superblock + bytes(BLOCK_SIZE - padding - len(superblock))
+                yield start + 1, len(descriptors) // BLOCK_SIZE, bytes(descriptors)
+            yield block_bitmap, 1, bitmap(allocated[group], length)
+            yield block_bitmap + 1, 1, bitmap(used_inodes, ipg)
+            table = b''.join(self.__inode(by_ino[ino]) if ino in by_ino else bytes(INODE_SIZE) for ino in
+                             range(group * ipg + 1, group * ipg + used_inodes + 1))
+            table += bytes(-len(table) % BLOCK_SIZE)
+            table_blocks = len(table) // BLOCK_SIZE
+            if table:
+                yield block_bitmap + 2, table_blocks, table
+            if table_blocks < ipg // INODES_PER_BLOCK:
+                yield block_bitmap + 2 + table_blocks, ipg // INODES_PER_BLOCK - table_blocks, None
+
+    def build(self, out_path, sparse=False):
+        """
+        Write the image to out_path, as an Android sparse image when sparse.
+        Returns the size of the filesystem in bytes.
+        """
+        last_ino = self.scan()
+        self.plan(last_ino)
+        allocated = self.allocate()
+        # (first block, block count, data or (path, offset, length) to copy, None for zeroed blocks)
+        items = list(self.metadata(allocated, last_ino))
+        for (xattrs, (block, refcount)) in self.xattr_blocks.items():
+            items.append((block, 1, self.__xattr_block(xattrs, refcount)))
+        for node in self.nodes:
+            items.extend((block, 1, data) for block, data in self.__leaves(node))
+            for logical, physical, length in node.extents:
+                if stat.S_ISREG(node.mode):
+                    offset = logical * BLOCK_SIZE
+                    items.append((physical, length, (node.path, offset, min(length * BLOCK_SIZE, node.size - offset))))
+                else:
+                    data = node.data[logical * BLOCK_SIZE:(logical + length) * BLOCK_SIZE]
+                    items.append((physical, length, data + bytes(length * BLOCK_SIZE - len(data))))
+        items.sort(key=lambda i: i[0])
+        with open(out_path, 'wb') as out:
+            writer = SparseWriter(out, BLOCK_SIZE, self.blocks_count) if sparse else out
+            self.__write(out, writer, items)
+            if sparse:
+                writer.close()
+            else:
+                out.truncate(self.blocks_count * BLOCK_SIZE)
+        return self.blocks_count * BLOCK_SIZE
+
+    @staticmethod
+    def __write(out, writer, items, buffsize=1048576):
+        sparse = writer is not out
+        out_fd = None if sparse or not hasattr(os, 'copy_file_range') else out.fileno()
+        source = None
+        try:
+            for block, count, data in items:
+                if data is None:
+                    # Unused inode table blocks must read as zeros, they are holes in a raw image
+                    if sparse:
+                        writer.seek(block * BLOCK_SIZE)
+                        writer.fill(count * BLOCK_SIZE)
+                    continue
+                writer.seek(block * BLOCK_SIZE)
+                if isinstance(data, bytes):
+                    writer.write(data)
+                    continue
+                path, offset, length = data
+                if source is None or source.name != path:
+                    if source:
+                        source.close()
+                    source = open(path, 'rb')
+                position = block * BLOCK_SIZE
+                remaining = length
+                while remaining and out_fd is not None:
+                    try:
+                        out.flush()
+                        n = os.copy_file_range(source.fileno(), out_fd, remaining, offset, position)
+                    except OSError:
+                        out_fd = None
+                        break
+                    if not n:
+                        raise EOFError(f"{path} is shorter than expected")
+                    offset += n
+                    position += n
+                    remaining -= n
+                if remaining:
+                    source.seek(offset)
+                    writer.seek(position)
+                    while remaining:
+                        chunk = source.read(min(remaining, buffsize))
+                        if not chunk:
+                            raise EOFError(f"{path} is shorter than expected")
+                        writer.write(chunk)
+                        remaining -= len(chunk)
+                if sparse and length % BLOCK_SIZE:
+                    writer.write(bytes(BLOCK_SIZE - length % BLOCK_SIZE))
+        finally:
+            if source:
+                source.close()
@@ -15,6 +15,7 @@
 # limitations under the License.
 from io import RawIOBase, UnsupportedOperation
 import os
+import threading
 
 import httpx
 
@@ -28,6 +29,8 @@ class HttpFile(RawIOBase):
         size = len(buf)
         end_pos = min(self.pos + size - 1, self.size - 1)
         size = end_pos - self.pos + 1
+        if size <= 0:
+            return 0
         headers = {"Range": f"bytes={self.pos}-{end_pos}"}
         n = 0
         with self.client.stream("GET", self.url, headers=headers) as r:
@@ -47,11 +50,29 @@ class HttpFile(RawIOBase):
         assert n == size
         return n
 
+    def read_range(self, start: int, length: int) -> bytes:
+        """
+        Fetch [start, start + length) with a single request, without moving the file position.
+        Safe to call from several threads at once.
+        """
+        if length <= 0:
+            return b''
+        headers = {"Range": f"bytes={start}-{start + length - 1}"}
+        r = self.client.get(self.url, headers=headers)
+        if r.status_code != 206:
+            raise UnsupportedOperation("Remote did not return partial content!")
+        data = r.content
+        if len(data) != length:
+            raise EOFError(f"Remote returned {len(data)} bytes, {length} expected")
+        with self.lock:
+            self.total_bytes += length
+        return data
+
     def readall(self) -> bytes:
         sz = self.size - self.pos
         buf = bytearray(sz)
         self._read_internal(buf)
-        return buf
+        return bytes(buf)
 
     def readinto(self, buffer) -> int:
         # print(f'read into from {self.pos}-{end_pos}')
@@ -89,11 +110,13 @@ class HttpFile(RawIOBase):
         self.size = size
         self.pos = 0
         self.total_bytes = 0
+        self.lock = threading.Lock()
         self.progress_reporter = progress_reporter
 
     def close(self) -> None:
         self.client.close()
 
+    @property
     def closed(self) -> bool:
         return self.client.is_closed
 
@@ -12,26 +12,96 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import fnmatch
 import logging
 import os
 import re
+import shutil
 import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from .posix import symlink
 from timeit import default_timer as dti
 from . import ext4
-from .utils import simg2img
+from .sparse_img import SparseImageFile
+
+
+def sparse_ext4(path: str) -> bool:
+    """
+    Whether the Android sparse image at path holds an ext4 filesystem.
+    """
+    with SparseImageFile(path) as f:
+        f.seek(0x438)
+        return f.read(2) == b'\x53\xef'
+
+
+class _LineWriter:
+    """
+    Stands in for a config line list and writes every appended line straight to file, the result is the same
+    as writing the joined list with Extractor.__write.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', newline='\n', encoding='utf-8')
+        self.last = None
+
+    def append(self, line):
+        if self.last is not None:
+            self.file.write(self.last + '\n')
+        self.last = line
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def close(self, discard=False):
+        """
+        :param discard: remove the file instead of finishing it, for a scan that failed halfway
+        """
+        if discard:
+            self.file.close()
+            os.remove(self.path)
+            return
+        self.file.write(('' if self.last is None else self.last).rstrip() + '\n')
+        self.file.close()
 
 
 class Extractor:
-    def __init__(self):
+    def __init__(self, workers=cpu_count()):
         self.CONFIG_DIR = None
         self.FileName = ""
         self.OUTPUT_IMAGE_FILE = ""
+        # Read OUTPUT_IMAGE_FILE as an Android sparse image, without converting it
+        self.sparse = False
+        self.sparse_image = None
+        # Callable returning a new file of the image, such as lpunpack.open_partition for a partition in super
+        self.opener = None
+        # Path globs to extract instead of the whole image
+        self.patterns = None
+        # Only write the configs, no directories or file contents
+        self.metadata_only = False
+        self.__recorded = set()
+        self.__extracted = set()
         self.EXTRACT_DIR = ""
         self.context = []
         self.fs_config = []
         self.space = []
+        # First (config path, file target) of every inode with more than one name
+        self.links = {}
+        # (config path, first config path, file target, first file target) of the names after the first one
+        self.hardlinks = []
+        # Decoded SELinux labels by raw xattr value, the same few labels repeat on every inode
+        self.labels = {}
         self.error_times = 0
+        # The directory walk stays on one thread, file contents are copied on this many threads
+        self.workers = workers
+        self.executor = None
+        self.copies = []
+        self.__local = threading.local()
+        self.__volumes = []
+        self.__volumes_lock = threading.Lock()
 
     @staticmethod
     def __out_name(file_path, out=1):
@@ -103,96 +173,249 @@ class Extractor:
             if self.error_times >= 200:
                 print("Some thing wrong,Stop!")
                 break
-            entry_inode = root_inode.volume.get_inode(entry_inode_idx, entry_type)
-            entry_inode_path = root_path + '/' + entry_name
-            if entry_inode_path[-1:] == '/' and not entry_inode.is_dir:
-                self.error_times += 1
-                continue
+            self.scan_entry(root_inode, root_path, entry_name, entry_inode_idx, entry_type)
 
-            mode = self.__get_perm(entry_inode.mode_str)
-            uid = entry_inode.inode.i_uid
-            gid = entry_inode.inode.i_gid
-            cap = ''
-            link_target = ''
-            tmp_path = self.FileName + entry_inode_path
-            for f, e in entry_inode.xattrs():
-                if f == 'security.selinux':
-                    t_p_mkc = tmp_path
-                    for fuk_ in '\\^$.|?*+(){}[]':
-                        t_p_mkc = t_p_mkc.replace(fuk_, f'\\{fuk_}')
-                    self.context.append(f"/{t_p_mkc} {e.decode('utf8')[:-1]}")
-                elif f == 'security.capability':
-                    r = struct.unpack('<5I', e)
-                    if r[1] > 65535:
-                        cap = hex(int(f'{r[3]:04x}{r[1]:04x}', 16))
-                    else:
-                        cap = hex(int(f'{r[3]:04x}{r[2]:04x}{r[1]:04x}', 16))
-                    cap = f" capabilities={cap}"
-            if entry_inode.is_symlink:
-                try:
-                    link_target = entry_inode.open_read().read().decode("utf8")
-                except Exception and BaseException:
-                    link_target_block = int.from_bytes(entry_inode.open_read().read(), "little")
-                    link_target = root_inode.volume.read(link_target_block * root_inode.volume.block_size,
-                                                         entry_inode.inode.i_size).decode("utf8")
-            if tmp_path.find(' ', 1, len(tmp_path)) > 0:
-                self.space.append(tmp_path)
-                self.fs_config.append(
-                    f"{tmp_path.replace(' ', '_')} {uid} {gid} {mode}{cap} {link_target}")
-            else:
-                self.fs_config.append(
-                    f'{tmp_path} {uid} {gid} {mode}{cap} {link_target}')
-            if entry_inode.is_dir:
-                dir_target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_').replace('"', '')
-                if dir_target.endswith('.') and os.name == 'nt':
-                    dir_target = dir_target[:-1]
-                if not os.path.isdir(dir_target):
-                    os.makedirs(dir_target)
-                if os.name == 'posix' and os.geteuid() == 0:
-                    os.chmod(dir_target, int(mode, 8))
-                    os.chown(dir_target, uid, gid)
+    def scan_entry(self, root_inode, root_path, entry_name, entry_inode_idx, entry_type, recursive=True):
+        """
+        Record and extract one entry of root_inode, directories are walked too when recursive.
+        """
+        entry_inode = root_inode.volume.get_inode(entry_inode_idx, entry_type)
+        entry_inode_path = root_path + '/' + entry_name
+        if entry_inode_path[-1:] == '/' and not entry_inode.is_dir:
+            self.error_times += 1
+            return
+
+        mode = self.__get_perm(entry_inode.mode_str)
+        uid = entry_inode.inode.i_uid
+        gid = entry_inode.inode.i_gid
+        cap = ''
+        link_target = ''
+        tmp_path = self.FileName + entry_inode_path
+        for f, e in entry_inode.xattrs():
+            if f == 'security.selinux':
+                t_p_mkc = tmp_path
+                for fuk_ in '\\^$.|?*+(){}[]':
+                    t_p_mkc = t_p_mkc.replace(fuk_, f'\\{fuk_}')
+                label = self.labels.get(e)
+                if label is None:
+                    label = self.labels[e] = e.decode('utf8')[:-1]
+                self.context.append(f"/{t_p_mkc} {label}")
+            elif f == 'security.capability':
+                r = struct.unpack('<5I', e)
+                if r[1] > 65535:
+                    cap = hex(int(f'{r[3]:04x}{r[1]:04x}', 16))
+                else:
+                    cap = hex(int(f'{r[3]:04x}{r[2]:04x}{r[1]:04x}', 16))
+                cap = f" capabilities={cap}"
+        if entry_inode.is_symlink:
+            try:
+                link_target = entry_inode.open_read().read().decode("utf8")
+            except Exception and BaseException:
+                link_target_block = int.from_bytes(entry_inode.open_read().read(), "little")
+                link_target = root_inode.volume.read(link_target_block * root_inode.volume.block_size,
+                                                     entry_inode.inode.i_size).decode("utf8")
+        if tmp_path.find(' ', 1, len(tmp_path)) > 0:
+            self.space.append(tmp_path)
+            self.fs_config.append(
+                f"{tmp_path.replace(' ', '_')} {uid} {gid} {mode}{cap} {link_target}")
+        else:
+            self.fs_config.append(
+                f'{tmp_path} {uid} {gid} {mode}{cap} {link_target}')
+        if entry_inode.is_file and entry_inode.inode.i_links_count > 1:
+            # Later names of the inode become hard links to the first one, its data is copied once
+            link = (tmp_path.replace(' ', '_'), self.EXTRACT_DIR + entry_inode_path.replace(' ', '_').replace('"', ''))
+            first = self.links.setdefault(entry_inode_idx, link)
+            if first != link:
+                self.hardlinks.append((link[0], first[0], link[1], first[1]))
+                return
+        if self.metadata_only:
+            if entry_inode.is_dir and recursive:
                 self.scan_dir(entry_inode, entry_inode_path)
-            elif entry_inode.is_file:
-                file_target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_').replace('"', '')
-                file_target_dirname = os.path.dirname(file_target)
-                if not os.path.exists(file_target_dirname):
-                    os.makedirs(file_target_dirname, exist_ok=True)
-                try:
-                    with open(file_target, 'wb') as out:
-                        out.write(entry_inode.open_read().read())
-                except Exception and BaseException as e:
-                    logging.exception('Ext4Extractor')
-                    print(f'[E] Cannot Write to {file_target}, Reason: {e}')
-                if os.name == 'posix' and os.geteuid() == 0:
-                    os.chmod(file_target, int(mode, 8))
-                    os.chown(file_target, uid, gid)
-            elif entry_inode.is_symlink:
-                target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_')
-                try:
-                    if os.path.islink(target) or os.path.isfile(target):
-                        try:
-                            os.remove(target)
-                        finally:
-                            ...
-                    symlink(link_target, target)
-                except BaseException and Exception:
+            return
+        if entry_inode.is_dir:
+            dir_target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_').replace('"', '')
+            if dir_target.endswith('.') and os.name == 'nt':
+                dir_target = dir_target[:-1]
+            if not os.path.isdir(dir_target):
+                os.makedirs(dir_target)
+            if os.name == 'posix' and os.geteuid() == 0:
+                os.chmod(dir_target, int(mode, 8))
+                os.chown(dir_target, uid, gid)
+            if recursive:
+                self.scan_dir(entry_inode, entry_inode_path)
+        elif entry_inode.is_file:
+            file_target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_').replace('"', '')
+            file_target_dirname = os.path.dirname(file_target)
+            if not os.path.exists(file_target_dirname):
+                os.makedirs(file_target_dirname, exist_ok=True)
+            if self.executor:
+                self.copies.append(
+                    self.executor.submit(self.__copy_in_worker, entry_inode_idx, file_target, mode, uid, gid))
+            else:
+                self.copy_file(entry_inode, file_target, mode, uid, gid)
+        elif entry_inode.is_symlink:
+            target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_')
+            try:
+                if os.path.islink(target) or os.path.isfile(target):
                     try:
-                        if link_target and link_target.isprintable():
-                            symlink(link_target, target)
+                        os.remove(target)
                     finally:
                         ...
+                symlink(link_target, target)
+            except BaseException and Exception:
+                try:
+                    if link_target and link_target.isprintable():
+                        symlink(link_target, target)
+                finally:
+                    ...
+
+    def scan_patterns(self, root_inode, patterns):
+        """
+        Extract only the paths matching patterns, shell globs of paths in the image such as /system/build.prop
+        or /vendor/etc/fstab.*. Matching directories are extracted with everything below them, the directories
+        leading to a match are created and recorded on the way.
+        """
+        self.__recorded.clear()
+        self.__extracted.clear()
+        for pattern in patterns:
+            parts = [i for i in pattern.split('/') if i]
+            if not parts or not self.__scan_pattern(root_inode, '', parts):
+                print(f"[W] Nothing matches {pattern}")
+
+    def __scan_pattern(self, dir_inode, dir_path, parts) -> int:
+        if any(i in parts[0] for i in '*?['):
+            entries = [entry for entry in dir_inode.open_dir() if
+                       entry[1] and entry[0] not in ['.', '..'] and fnmatch.fnmatchcase(entry[0], parts[0])]
+        else:
+            # Plain names go through the hash tree index when the directory has one
+            entry = dir_inode.lookup(parts[0])
+            entries = [entry] if entry else []
+        matched = 0
+        for entry_name, entry_inode_idx, entry_type in entries:
+            entry_path = dir_path + '/' + entry_name
+            if any(entry_path == i or entry_path.startswith(i + '/') for i in self.__extracted):
+                matched += 1
+                continue
+            if len(parts) == 1:
+                self.scan_entry(dir_inode, dir_path, entry_name, entry_inode_idx, entry_type)
+                self.__extracted.add(entry_path)
+                self.__recorded.add(entry_path)
+                matched += 1
+                continue
+            entry_inode = dir_inode.volume.get_inode(entry_inode_idx, entry_type)
+            if not entry_inode.is_dir:
+                continue
+            if entry_path not in self.__recorded:
+                self.scan_entry(dir_inode, dir_path, entry_name, entry_inode_idx, entry_type, recursive=False)
+                self.__recorded.add(entry_path)
+            matched += self.__scan_pattern(entry_inode, entry_path, parts[1:])
+        return matched
+
+    @staticmethod
+    def copy_file(inode, file_target, mode, uid, gid):
+        try:
+            with open(file_target, 'wb') as out:
+                reader = inode.open_read()
+                if isinstance(reader, ext4.BlockReader):
+                    reader.copy_to(out, sparse=True)
+                else:
+                    out.write(reader.read())
+        except Exception and BaseException as e:
+            logging.exception('Ext4Extractor')
+            print(f'[E] Cannot Write to {file_target}, Reason: {e}')
+        if os.name == 'posix' and os.geteuid() == 0:
+            os.chmod(file_target, int(mode, 8))
+            os.chown(file_target, uid, gid)
+
+    @staticmethod
+    def link_file(first_target, file_target):
+        """
+        Make file_target another name of first_target, or a copy of it where hard links are not supported.
+        """
+        if os.path.lexists(file_target):
+            os.remove(file_target)
+        os.makedirs(os.path.dirname(file_target), exist_ok=True)
+        try:
+            os.link(first_target, file_target)
+        except OSError:
+            shutil.copy2(first_target, file_target)
+
+    def __copy_in_worker(self, inode_idx, file_target, mode, uid, gid):
+        # Every worker thread reads the image through its own file and Volume
+        try:
+            volume = getattr(self.__local, 'volume', None)
+            if volume is None:
+                volume = self.__local.volume = ext4.Volume(self.open_image(), use_mmap=True, bulk_inodes=True)
+                with self.__volumes_lock:
+                    self.__volumes.append(volume)
+            self.copy_file(volume.get_inode(inode_idx, ext4.InodeType.FILE), file_target, mode, uid, gid)
+        except Exception as e:
+            logging.exception('Ext4Extractor')
+            print(f'[E] Cannot Write to {file_target}, Reason: {e}')
+
+    def open_image(self):
+        if self.opener:
+            return self.opener()
+        if not self.sparse:
+            return open(self.OUTPUT_IMAGE_FILE, 'rb')
+        # The chunk table is parsed once and shared by every reader
+        file = SparseImageFile(self.OUTPUT_IMAGE_FILE, self.sparse_image)
+        self.sparse_image = file.image
+        return file
 
     def __ext4extractor(self):
         if not os.path.isdir(self.CONFIG_DIR):
             os.makedirs(self.CONFIG_DIR)
-        self.__write(os.path.getsize(self.OUTPUT_IMAGE_FILE), self.CONFIG_DIR + os.sep + self.FileName + '_size.txt')
-        with open(self.OUTPUT_IMAGE_FILE, 'rb') as file:
+        with self.open_image() as file:
+            self.__write(file.seek(0, os.SEEK_END), self.CONFIG_DIR + os.sep + self.FileName + '_size.txt')
             dir_r = self.FileName
-            self.scan_dir(ext4.Volume(file).root)
-            self.fs_config.insert(0, '/ 0 2000 0755' if dir_r == 'vendor' else '/ 0 0 0755')
-            self.fs_config.insert(1, f'{dir_r} 0 2000 0755' if dir_r == 'vendor' else '/lost+found 0 0 0700')
-            self.fs_config.insert(2 if dir_r == 'system' else 1, f'{dir_r} 0 0 0755')
-            self.__write('\n'.join(self.fs_config), self.CONFIG_DIR + os.sep + self.FileName + '_fs_config')
+            fs_config_header = ['/ 0 2000 0755' if dir_r == 'vendor' else '/ 0 0 0755',
+                                f'{dir_r} 0 2000 0755' if dir_r == 'vendor' else '/lost+found 0 0 0700']
+            fs_config_header.insert(2 if dir_r == 'system' else 1, f'{dir_r} 0 0 0755')
+            if self.metadata_only:
+                # Lines go to disk as they are found
+                self.fs_config = _LineWriter(self.CONFIG_DIR + os.sep + self.FileName + '_fs_config')
+                self.fs_config.extend(fs_config_header)
+            elif self.workers > 1:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            volume = None
+            scanned = False
+            try:
+                volume = ext4.Volume(file, use_mmap=True, bulk_inodes=True)
+                if self.patterns:
+                    self.scan_patterns(volume.root, self.patterns)
+                else:
+                    self.scan_dir(volume.root)
+                scanned = True
+            finally:
+                if self.metadata_only:
+                    self.fs_config.close(discard=not scanned)
+                    self.fs_config = []
+                if self.executor:
+                    self.executor.shutdown()
+                    self.executor = None
+                    for worker_volume in self.__volumes:
+                        worker_volume.close()
+                        worker_volume.stream.close()
+                    self.__volumes.clear()
+                if volume:
+                    volume.close()
+                # Every copy has finished after the shutdown, none is left for the next image
+                copies, self.copies = self.copies, []
+            for copy in copies:
+                copy.result()
+            if self.hardlinks:
+                self.__write('\n'.join(f'{path} {first_path}' for path, first_path, *_ in self.hardlinks),
+                             os.path.join(self.CONFIG_DIR, self.FileName + '_hardlinks.txt'))
+                if not self.metadata_only:
+                    for *_, file_target, first_target in self.hardlinks:
+                        try:
+                            self.link_file(first_target, file_target)
+                        except OSError as e:
+                            print(f'[E] Cannot link {file_target} to {first_target}, Reason: {e}')
+            if not self.metadata_only:
+                self.fs_config[:0] = fs_config_header
+                self.__write('\n'.join(self.fs_config), self.CONFIG_DIR + os.sep + self.FileName + '_fs_config')
             if self.space:
                 self.__write('\n'.join(self.space), os.path.join(self.CONFIG_DIR, self.FileName + '_space.txt'))
             p1 = p2 = 0
@@ -259,13 +482,28 @@ class Extractor:
                     f"Expected:{real_size}\nGot:{orig_size}")
                 file.truncate(real_size)
 
-    def main(self, target: str, output_dir: str, work: str, target_type: str = 'img'):
+    def main(self, target: str, output_dir: str, work: str, target_type: str = 'img', opener=None, patterns=None,
+             metadata_only=False):
+        """
+        :param opener: callable returning a new readable, seekable file of the image, the image is then read
+                       through it and target only names it
+        :param patterns: path globs to extract, such as ['/system/build.prop', '/vendor/etc/fstab.*'],
+                         everything is extracted when empty
+        :param metadata_only: only write the fs_config, file_contexts and size files, without reading file data
+        """
         self.EXTRACT_DIR = os.path.realpath(os.path.dirname(output_dir)) + os.sep + self.__out_name(
             os.path.basename(output_dir))
         self.OUTPUT_IMAGE_FILE = (os.path.realpath(os.path.dirname(target)) + os.sep) + os.path.basename(target)
         self.FileName = self.__out_name(os.path.basename(target), out=0)
         self.CONFIG_DIR = work + os.sep + 'config'
-        with open(self.OUTPUT_IMAGE_FILE, 'rb+') as file:
+        self.sparse = target_type == 's_img'
+        self.sparse_image = None
+        self.opener = opener
+        self.patterns = patterns
+        self.metadata_only = metadata_only
+        self.links.clear()
+        self.hardlinks.clear()
+        with self.open_image() as file:
             mount = ext4.Volume(file).get_mount_point
             if mount[:1] == '/':
                 mount = mount[1:]
@@ -279,16 +517,15 @@ class Extractor:
                     f"[N]:Filename appears to be wrong , We will Extract {self.OUTPUT_IMAGE_FILE} to {mount}")
                 self.EXTRACT_DIR = os.path.realpath(os.path.dirname(output_dir)) + os.sep + mount
                 self.FileName = mount
-        if target_type == 's_img':
-            simg2img(target)
-            target_type = 'img'
-        if target_type == 'img':
+        # The fixes rewrite the image, a metadata scan leaves it as it is
+        if target_type == 'img' and not opener and not metadata_only:
             with open(os.path.abspath(self.OUTPUT_IMAGE_FILE), 'rb') as f:
                 data = f.read(500000)
             if re.search(b'\x4d\x4f\x54\x4f', data):
                 print(".....MOTO structure! Fixing.....")
                 self.fix_moto(os.path.abspath(self.OUTPUT_IMAGE_FILE))
             self.fix_size()
+        if target_type in ('img', 's_img'):
             print(f"Extracting {os.path.basename(target)} --> {os.path.basename(self.EXTRACT_DIR)}")
             start = dti()
             self.__ext4extractor()
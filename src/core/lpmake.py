@@ -0,0 +1,166 @@
+# Copyright (C) 2022-2025 The MIO-KITCHEN-SOURCE Project
+#
+# Licensed under the GNU AFFERO GENERAL PUBLIC LICENSE, Version 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.gnu.org/licenses/agpl-3.0.en.html#license-text
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Lay out a super image the way lpmake does, without writing partition data.
+The layout gives the metadata region and the byte extent of every partition, so images can be
+written straight into their final place.
+"""
+import hashlib
+import struct
+
+from .lpunpack import LP_METADATA_GEOMETRY_MAGIC, LP_METADATA_GEOMETRY_SIZE, LP_METADATA_HEADER_MAGIC, \
+    LP_PARTITION_ATTR_READONLY, LP_PARTITION_RESERVED_BYTES, LP_SECTOR_SIZE, LP_TARGET_TYPE_LINEAR
+
+LP_HEADER_FLAG_VIRTUAL_AB_DEVICE = 0x1
+DEFAULT_ALIGNMENT = 1048576
+LOGICAL_BLOCK_SIZE = 4096
+
+
+def align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+class SuperLayout:
+    """
+    :param partitions: list of (name, size, group name, attributes)
+    :param groups: list of (name, maximum size)
+    """
+
+    def __init__(self, device_size, partitions, groups, block_device_name='super', metadata_size=65536,
+                 metadata_slots=2, virtual_ab=False, alignment=DEFAULT_ALIGNMENT):
+        self.device_size = device_size
+        self.block_device_name = block_device_name
+        self.metadata_size = metadata_size
+        self.metadata_slots = metadata_slots
+        self.virtual_ab = virtual_ab
+        self.alignment = alignment
+        self.groups = [('default', 0)] + list(groups)
+        group_index = {name: index for index, (name, _) in enumerate(self.groups)}
+        reserved = LP_PARTITION_RESERVED_BYTES + (LP_METADATA_GEOMETRY_SIZE + metadata_size * metadata_slots) * 2
+        self.first_logical_sector = align(reserved, alignment) // LP_SECTOR_SIZE
+        if self.first_logical_sector * LP_SECTOR_SIZE > device_size:
+            raise ValueError("Super is too small for its metadata")
+        # Free regions as [start sector, end sector)
+        free = [(self.first_logical_sector, device_size // LP_SECTOR_SIZE)]
+        group_usage = {}
+        self.partitions = []
+        # name -> [(offset in super, length)]
+        self.extents = {}
+        for name, size, group, attributes in partitions:
+            if group not in group_index:
+                raise ValueError(f"Partition {name} uses unknown group {group}")
+            size = align(size, LOGICAL_BLOCK_SIZE)
+            group_usage[group] = group_usage.get(group, 0) + size
+            group_size = self.groups[group_index[group]][1]
+            if group_size and group_usage[group] > group_size:
+                raise ValueError(f"Partition {name} does not fit in group {group}")
+            sectors = size // LP_SECTOR_SIZE
+            extents = []
+            for start, end in free:
+                if not sectors:
+                    break
+                start = align(start * LP_SECTOR_SIZE, alignment) // LP_SECTOR_SIZE
+                if start >= end:
+                    continue
+                count = min(sectors, end - start)
+                extents.append((start, count))
+                sectors -= count
+            if sectors:
+                raise ValueError(f"Not enough space on super for partition {name}")
+            for start, count in extents:
+                free = self.__take(free, start, start + count)
+            self.partitions.append((name, attributes, len(extents), group_index[group]))
+            self.extents[name] = [(start * LP_SECTOR_SIZE, count * LP_SECTOR_SIZE) for start, count in extents]
+
+    @staticmethod
+    def __take(free, start, end):
+        regions = []
+        for region_start, region_end in free:
+            if end <= region_start or start >= region_end:
+                regions.append((region_start, region_end))
+                continue
+            if region_start < start:
+                regions.append((region_start, start))
+            if end < region_end:
+                regions.append((end, region_end))
+        return regions
+
+    def geometry(self) -> bytes:
+        def pack(checksum):
+            return struct.pack('<2I32s3I', LP_METADATA_GEOMETRY_MAGIC, 52, checksum, self.metadata_size,
+                               self.metadata_slots, LOGICAL_BLOCK_SIZE)
+
+        geometry = pack(hashlib.sha256(pack(bytes(32))).digest())
+        return geometry + bytes(LP_METADATA_GEOMETRY_SIZE - len(geometry))
+
+    def metadata(self) -> bytes:
+        partitions = b''
+        extents = b''
+        extent_count = 0
+        for name, attributes, num_extents, group in self.partitions:
+            partitions += struct.pack('<36s4I', name.encode(), attributes, extent_count, num_extents, group)
+            for offset, length in self.extents[name]:
+                extents += struct.pack('<QIQI', length // LP_SECTOR_SIZE, LP_TARGET_TYPE_LINEAR,
+                                       offset // LP_SECTOR_SIZE, 0)
+            extent_count += num_extents
+        groups = b''.join(struct.pack('<36sIQ', name.encode(), 0, size) for name, size in self.groups)
+        block_devices = struct.pack('<Q2IQ36sI', self.first_logical_sector, self.alignment, 0, self.device_size,
+                                    self.block_device_name.encode(), 0)
+        tables = partitions + extents + groups + block_devices
+        if self.virtual_ab:
+            minor_version, header_size, flags = 2, 256, LP_HEADER_FLAG_VIRTUAL_AB_DEVICE
+        else:
+            minor_version, header_size, flags = 0, 128, 0
+
+        def pack(checksum):
+            header = struct.pack('<I2HI32sI32s12I', LP_METADATA_HEADER_MAGIC, 10, minor_version, header_size,
+                                 checksum, len(tables), hashlib.sha256(tables).digest(),
+                                 0, len(self.partitions), 52,
+                                 len(partitions), extent_count, 24,
+                                 len(partitions) + len(extents), len(self.groups), 48,
+                                 len(partitions) + len(extents) + len(groups), 1, 64)
+            if header_size > 128:
+                header += struct.pack('<I', flags)
+            return header + bytes(header_size - len(header))
+
+        metadata = pack(hashlib.sha256(pack(bytes(32))).digest()) + tables
+        if len(metadata) > self.metadata_size:
+            raise ValueError("Partition metadata does not fit in metadata_size")
+        return metadata + bytes(self.metadata_size - len(metadata))
+
+    def metadata_region(self) -> bytes:
+        """
+        Everything before the first logical sector: reserved bytes, geometry, its backup and the metadata slots
+        with their backups.
+        """
+        geometry = self.geometry()
+        slots = self.metadata() * self.metadata_slots
+        region = bytes(LP_PARTITION_RESERVED_BYTES) + geometry + geometry + slots + slots
+        return region + bytes(self.first_logical_sector * LP_SECTOR_SIZE - len(region))
+
+
+def super_layout(sizes, group_name: str, size: int, super_type, attrib='readonly', block_device_name='super'):
+    """
+    Layout with the same partitions and groups pack_super passes to lpmake.
+    :param sizes: list of (partition name, image size) in packing order
+    :param super_type: 1 A-only, 2 Virtual-ab, 3 A/B
+    """
+    attributes = LP_PARTITION_ATTR_READONLY if attrib == 'readonly' else 0
+    if super_type == 1:
+        return SuperLayout(size, [(name, part_size, group_name, attributes) for name, part_size in sizes],
+                           [(group_name, size)], block_device_name=block_device_name, metadata_slots=2)
+    partitions = [(f'{name}_a', part_size, f'{group_name}_a', attributes) for name, part_size in sizes]
+    partitions += [(f'{name}_b', 0, f'{group_name}_b', attributes) for name, _ in sizes]
+    return SuperLayout(size, partitions, [(f'{group_name}_a', size), (f'{group_name}_b', size)],
+                       block_device_name='super', metadata_slots=3, virtual_ab=super_type == 2)
@@ -7,11 +7,14 @@ import json
 import os
 import struct
 import sys
+from bisect import bisect_right
 from dataclasses import dataclass, field
 from string import Template
 from timeit import default_timer as dti
 from typing import IO, Dict, List, TypeVar, cast, BinaryIO, Tuple
 
+from .sparse_img import SparseImageFile
+
 SPARSE_HEADER_MAGIC = 0xED26FF3A
 SPARSE_HEADER_SIZE = 28
 SPARSE_CHUNK_HEADER_SIZE = 12
@@ -671,6 +674,67 @@ class SparseImage:
         return unsparse_file
 
 
+class LpPartitionFile(io.RawIOBase):
+    """
+    Read-only, seekable block device of one logical partition, its extents are mapped onto offsets in super.img.
+    :param super_file: opened super image, closed together with this file
+    :param extents: [(offset in super, size)] in partition order, as in UnpackJob.parts
+    """
+
+    def __init__(self, super_file, extents: List[Tuple[int, int]]):
+        super().__init__()
+        self._fd = super_file
+        self.extents = extents
+        # Start of every extent inside the partition
+        self.starts = []
+        self.size = 0
+        for _, size in extents:
+            self.starts.append(self.size)
+            self.size += size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.pos = offset
+        return offset
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        end = min(self.pos + len(view), self.size)
+        done = 0
+        while self.pos < end:
+            index = bisect_right(self.starts, self.pos) - 1
+            offset, size = self.extents[index]
+            skip = self.pos - self.starts[index]
+            length = min(end - self.pos, size - skip)
+            self._fd.seek(offset + skip)
+            got = self._fd.readinto(view[done:done + length])
+            done += got
+            self.pos += got
+            if got != length:
+                break
+        return done
+
+    def close(self):
+        if not self.closed:
+            self._fd.close()
+        super().close()
+
+
 T = TypeVar('T')
 
 
@@ -703,21 +767,23 @@ class LpUnpack:
 
         print(f'Done:[{dti() - start}]')
 
-    def _extract(self, partition, metadata):
-        unpack_job = UnpackJob(name=partition.name, geometry=metadata.geometry)
+    @staticmethod
+    def _get_extents(partition, metadata) -> List[Tuple[int, int]]:
+        extents = []
+        for extent_number in range(partition.num_extents):
+            index = partition.first_extent_index + extent_number
+            extent = metadata.extents[index]
 
-        if partition.num_extents != 0:
-            for extent_number in range(partition.num_extents):
-                index = partition.first_extent_index + extent_number
-                extent = metadata.extents[index]
+            if extent.target_type != LP_TARGET_TYPE_LINEAR:
+                raise LpUnpackError(f'Unsupported target type in extent: {extent.target_type}')
 
-                if extent.target_type != LP_TARGET_TYPE_LINEAR:
-                    raise LpUnpackError(f'Unsupported target type in extent: {extent.target_type}')
+            extents.append((extent.target_data * LP_SECTOR_SIZE, extent.num_sectors * LP_SECTOR_SIZE))
+        return extents
 
-                offset = extent.target_data * LP_SECTOR_SIZE
-                size = extent.num_sectors * LP_SECTOR_SIZE
-                unpack_job.parts.append((offset, size))
-                unpack_job.total_size += size
+    def _extract(self, partition, metadata):
+        unpack_job = UnpackJob(name=partition.name, geometry=metadata.geometry)
+        unpack_job.parts = self._get_extents(partition, metadata)
+        unpack_job.total_size = sum(size for _, size in unpack_job.parts)
 
         self._extract_partition(unpack_job)
 
@@ -897,6 +963,24 @@ class LpUnpack:
         finally:
             self._fd.close()
 
+    def get_extents(self) -> Dict[str, List[Tuple[int, int]]]:
+        """
+        Return {partition name: [(offset in super, size)]} without extracting anything.
+        Sparse super images are read in place, so the offsets are in the raw image.
+        """
+        try:
+            if SparseImage(self._fd).check():
+                self._fd.close()
+                self._fd = SparseImageFile(self._fd.name)
+            self._fd.seek(0)
+            metadata = self._read_metadata()
+            return {partition.name: self._get_extents(partition, metadata) for partition in metadata.partitions}
+        except LpUnpackError as e:
+            print(e.message)
+            sys.exit(1)
+        finally:
+            self._fd.close()
+
     def get_info(self):
         try:
             if SparseImage(self._fd).check():
@@ -938,3 +1022,33 @@ def get_parts(file_):
         raise FileNotFoundError(f"{namespace.SUPER_IMAGE} Cannot Find")
     else:
         return LpUnpack(**vars(namespace)).get_parts()
+
+
+def get_extents(file: str) -> Dict[str, List[Tuple[int, int]]]:
+    namespace = argparse.Namespace(SUPER_IMAGE=file, SHOW_INFO=False)
+    if not os.path.exists(namespace.SUPER_IMAGE):
+        raise FileNotFoundError(f"{namespace.SUPER_IMAGE} Cannot Find")
+    else:
+        return LpUnpack(**vars(namespace)).get_extents()
+
+
+def open_super(file: str):
+    """
+    Open super.img for reading, sparse images are read in place.
+    """
+    with open(file, 'rb') as f:
+        sparse = SparseImage(f).check()
+    return SparseImageFile(file) if sparse else open(file, 'rb')
+
+
+def open_partition(file: str, name: str, extents: List[Tuple[int, int]] = None) -> LpPartitionFile:
+    """
+    Open a logical partition of super.img as a file, nothing is extracted.
+    :param extents: extents of the partition from get_extents, read from the metadata when None
+    """
+    if extents is None:
+        partitions = get_extents(file)
+        if name not in partitions:
+            raise LpUnpackError(f'Could not find partition: {name}')
+        extents = partitions[name]
+    return LpPartitionFile(open_super(file), extents)
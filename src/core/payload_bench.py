@@ -0,0 +1,263 @@
+# Copyright (C) 2022-2025 The MIO-KITCHEN-SOURCE Project
+#
+# Licensed under the GNU AFFERO GENERAL PUBLIC LICENSE, Version 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.gnu.org/licenses/agpl-3.0.en.html#license-text
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark Dumper on synthetic payloads.
+    python -m src.core.payload_bench --size 256 --mix replace=1,xz=1,bz2=1,zstd=2,zero=1 --output result.json
+Every mode runs in a fresh process whose peak RSS is counted from the start of the mode, on Linux only, elsewhere
+it is null. The result is printed as JSON.
+"""
+import argparse
+import bz2
+import contextlib
+import hashlib
+import json
+import lzma
+import os
+import platform
+import random
+import shutil
+import struct
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count, get_context
+
+import zstandard
+
+from . import update_metadata_pb2 as um
+from .dumper import Dumper, apply_op
+from .payload_index import read_index
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+Op = um.InstallOperation
+OP_TYPES = {
+    'replace': (Op.REPLACE, lambda data: data),
+    'xz': (Op.REPLACE_XZ, lambda data: lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32)),
+    'bz2': (Op.REPLACE_BZ, lambda data: bz2.compress(data, 9)),
+    'zstd': (Op.REPLACE_ZSTD, lambda data: zstandard.ZstdCompressor(level=3).compress(data)),
+    'zero': (Op.ZERO, None),
+}
+MODES = {
+    'slow': ({}, True),
+    'thread': ({}, False),
+    'split': ({'split_ops': True}, False),
+    'process': ({'backend': 'process'}, False),
+    'sparse': ({'sparse': True}, False),
+    'verify': ({'split_ops': True, 'verify': True}, False),
+}
+
+
+def synthetic_data(rng, length, compressibility):
+    """
+    Chunk whose first part is random and the rest a repeated pattern, so compressors have work to do.
+    """
+    random_length = int(length * (1 - compressibility))
+    pattern = rng.randbytes(64)
+    return rng.randbytes(random_length) + (pattern * (length // 64 + 1))[:length - random_length]
+
+
+def make_payload(path, partitions, size, op_size, mix, compressibility=0.5, block_size=4096, seed=0):
+    """
+    Write a synthetic full payload.
+    :param partitions: number of partitions
+    :param size: size of every partition in bytes, rounded up to op_size
+    :param mix: {op type name: weight}
+    """
+    rng = random.Random(seed)
+    names = [i for i in mix if mix[i] > 0]
+    weights = [mix[i] for i in names]
+    manifest = um.DeltaArchiveManifest()
+    manifest.block_size = block_size
+    blob = tempfile.TemporaryFile()
+    data_offset = 0
+    ops = -(-size // op_size)
+    for index in range(partitions):
+        part = manifest.partitions.add()
+        part.partition_name = f'bench{index}'
+        part.new_partition_info.size = ops * op_size
+        digest = hashlib.sha256()
+        for op_index in range(ops):
+            op_type, compress = OP_TYPES[rng.choices(names, weights)[0]]
+            op = part.operations.add()
+            op.type = op_type
+            extent = op.dst_extents.add()
+            extent.start_block = op_index * op_size // block_size
+            extent.num_blocks = op_size // block_size
+            if compress is None:
+                digest.update(bytes(op_size))
+                continue
+            data = synthetic_data(rng, op_size, compressibility)
+            digest.update(data)
+            data = compress(data)
+            op.data_offset = data_offset
+            op.data_length = len(data)
+            op.data_sha256_hash = hashlib.sha256(data).digest()
+            blob.write(data)
+            data_offset += len(data)
+        part.new_partition_info.hash = digest.digest()
+    manifest_data = manifest.SerializeToString()
+    with open(path, 'wb') as f:
+        f.write(b'CrAU' + struct.pack('>QQI', 2, len(manifest_data), 0))
+        f.write(manifest_data)
+        blob.seek(0)
+        shutil.copyfileobj(blob, f, 1048576)
+    blob.close()
+
+
+def reset_peak_rss() -> bool:
+    """
+    Restart the peak RSS count of this process, Linux only. A spawned process starts with the peak of its parent,
+    without this the peak of a mode can not be told apart from it.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """
+    Peak RSS in bytes since reset_peak_rss: VmHWM of this process or the largest ru_maxrss of the worker processes
+    it forked and waited for, whichever is higher. None where it can not be read.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            own = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration, ValueError):
+        return None
+    # Forked children start counting from their own RSS, only exec carries a peak over
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024 if resource else 0
+    return max(own, children)
+
+
+def run_mode(payload, out, mode, workers):
+    kwargs, slow = MODES[mode]
+    shutil.rmtree(out, ignore_errors=True)
+    os.makedirs(out)
+    measured = reset_peak_rss()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        ok = Dumper(payload, out, workers=workers, **kwargs).run(slow=slow)
+        seconds = time.perf_counter() - start
+    shutil.rmtree(out, ignore_errors=True)
+    return {'seconds': seconds, 'ok': ok, 'peak_rss': peak_rss() if measured else None}
+
+
+def op_type_times(payload, out, buffsize=8192):
+    """
+    Apply every operation once on a single thread and sum the time spent per operation type.
+    """
+    with open(payload, 'rb') as payloadfile:
+        index = read_index(payloadfile)
+        times = {}
+        os.makedirs(out, exist_ok=True)
+        with open(os.path.join(out, 'op.img'), 'wb') as out_file:
+            for part in index.partitions:
+                for op in part.operations:
+                    start = time.perf_counter()
+                    apply_op(op, payloadfile, out_file, None, index.block_size, buffsize)
+                    name = Op.Type.Name(op.type)
+                    entry = times.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+                    entry['count'] += 1
+                    entry['seconds'] += time.perf_counter() - start
+                    entry['bytes'] += sum(num_blocks for _, num_blocks in op.dst_extents) * index.block_size
+                out_file.truncate(0)
+    shutil.rmtree(out, ignore_errors=True)
+    return times
+
+
+def benchmark(partitions=2, size=134217728, op_size=2097152, mix=None, compressibility=0.5, modes=tuple(MODES),
+              workers=cpu_count(), repeat=1, workdir=None, seed=0):
+    mix = mix or {i: 1 for i in OP_TYPES}
+    workdir = tempfile.mkdtemp(prefix='payload_bench_', dir=workdir)
+    payload = os.path.join(workdir, 'payload.bin')
+    try:
+        make_payload(payload, partitions, size, op_size, mix, compressibility, seed=seed)
+        image_bytes = partitions * -(-size // op_size) * op_size
+        result = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': cpu_count(),
+            'workers': workers,
+            'payload': {'partitions': partitions, 'image_bytes': image_bytes, 'payload_bytes': os.path.getsize(payload),
+                        'op_size': op_size, 'mix': mix, 'compressibility': compressibility, 'seed': seed},
+            'modes': {},
+        }
+        for mode in modes:
+            runs = []
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                    runs.append(executor.submit(run_mode, payload, os.path.join(workdir, 'out'), mode, workers).result())
+            best = min(run['seconds'] for run in runs)
+            result['modes'][mode] = {
+                'seconds': best,
+                'mb_per_s': image_bytes / 1048576 / best,
+                'peak_rss': max((run['peak_rss'] or 0) for run in runs) or None,
+                'ok': all(run['ok'] for run in runs),
+                'runs': [run['seconds'] for run in runs],
+            }
+        result['op_types'] = op_type_times(payload, os.path.join(workdir, 'ops'))
+        for entry in result['op_types'].values():
+            entry['mb_per_s'] = entry['bytes'] / 1048576 / entry['seconds'] if entry['seconds'] else None
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OP_TYPES:
+            raise argparse.ArgumentTypeError(f"unknown operation type {name}, choose from {', '.join(OP_TYPES)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark payload dumping on synthetic payloads')
+    parser.add_argument('--partitions', type=int, default=2, help='number of partitions')
+    parser.add_argument('--size', type=int, default=128, help='size of every partition in MiB')
+    parser.add_argument('--op-size', type=int, default=2048, help='size of every operation in KiB')
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help='operation weights, e.g. replace=1,xz=1,bz2=1,zstd=2,zero=1')
+    parser.add_argument('--compressibility', type=float, default=0.5, help='compressible share of the data, 0-1')
+    parser.add_argument('--modes', default=','.join(MODES), help=f"comma separated, from {', '.join(MODES)}")
+    parser.add_argument('--workers', type=int, default=cpu_count())
+    parser.add_argument('--repeat', type=int, default=1, help='runs per mode, the fastest is reported')
+    parser.add_argument('--workdir', default=None, help='directory for the payload and images')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='also write the JSON result to this file')
+    args = parser.parse_args(argv)
+    modes = [i for i in args.modes.split(',') if i]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"unknown mode {mode}")
+    result = benchmark(args.partitions, args.size * 1048576, args.op_size * 1024, args.mix, args.compressibility,
+                       modes, args.workers, args.repeat, args.workdir, args.seed)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
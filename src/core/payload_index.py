@@ -0,0 +1,198 @@
+# Copyright (C) 2022-2025 The MIO-KITCHEN-SOURCE Project
+#
+# Licensed under the GNU AFFERO GENERAL PUBLIC LICENSE, Version 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.gnu.org/licenses/agpl-3.0.en.html#license-text
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compact index of a payload.bin manifest.
+Everything the dumper needs is kept in a small binary file cached on disk, keyed by the payload path,
+offset, size and mtime, so listing partitions or planning a dump does not parse the protobuf manifest again.
+"""
+import hashlib
+import os
+import struct
+import zipfile
+from collections import namedtuple
+
+from . import update_metadata_pb2 as um
+
+# Plain description of an install operation, cheap to pickle for process workers.
+# Extents are (start_block, num_blocks) tuples, data_offset is absolute in the payload file.
+OpDescriptor = namedtuple('OpDescriptor',
+                          ['data_offset', 'data_length', 'dst_extents', 'type', 'src_extents', 'data_sha256_hash'])
+# size and hash are new_partition_info.size and new_partition_info.hash.
+PartitionEntry = namedtuple('PartitionEntry', ['name', 'size', 'hash', 'operations'])
+# groups are the dynamic partition groups as (name, size, [partition names]).
+PayloadIndex = namedtuple('PayloadIndex', ['block_size', 'data_offset', 'partitions', 'groups'])
+
+INDEX_MAGIC = b'MIOPIDX\x02'
+_header = struct.Struct('<8sIQII')  # magic, block_size, data_offset, partitions, groups
+_group = struct.Struct('<HQI')  # name length, size, partition names
+_partition = struct.Struct('<HQBI')  # name length, size, hash length, operations
+_op = struct.Struct('<BQQBII')  # type, data_offset, data_length, hash length, src extents, dst extents
+
+
+def zip_member_offset(file, member: str) -> int:
+    """
+    Return the offset of the data of a ZIP_STORED member, so it can be read in place.
+    :param file: zip file object, must be seekable
+    :param member: name of the member
+    """
+    with zipfile.ZipFile(file) as zf:
+        info = zf.getinfo(member)
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f"{member} is compressed, it cannot be read in place")
+    file.seek(info.header_offset)
+    header = file.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header of {member}")
+    name_length, extra_length = struct.unpack('<2H', header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+def read_index(payloadfile) -> PayloadIndex:
+    """
+    Parse the manifest of the payload starting at the current position of payloadfile.
+    """
+    if payloadfile.read(4) != b'CrAU':
+        raise ValueError("Not a payload, magic check fail")
+    file_format_version = struct.unpack('>Q', payloadfile.read(8))[0]
+    if file_format_version != 2:
+        raise ValueError(f"Unsupported payload version {file_format_version}")
+    manifest_size = struct.unpack('>Q', payloadfile.read(8))[0]
+    metadata_signature_size = struct.unpack('>I', payloadfile.read(4))[0]
+    manifest = payloadfile.read(manifest_size)
+    payloadfile.seek(metadata_signature_size, os.SEEK_CUR)
+    data_offset = payloadfile.tell()
+    dam = um.DeltaArchiveManifest()
+    dam.ParseFromString(manifest)
+    partitions = []
+    for partition in dam.partitions:
+        operations = [
+            OpDescriptor(
+                data_offset + operation.data_offset,
+                operation.data_length,
+                tuple((ext.start_block, ext.num_blocks) for ext in operation.dst_extents),
+                operation.type,
+                tuple((ext.start_block, ext.num_blocks) for ext in operation.src_extents),
+                operation.data_sha256_hash,
+            )
+            for operation in partition.operations
+        ]
+        partitions.append(PartitionEntry(partition.partition_name, partition.new_partition_info.size,
+                                         partition.new_partition_info.hash, operations))
+    groups = [(group.name, group.size, list(group.partition_names))
+              for group in dam.dynamic_partition_metadata.groups]
+    return PayloadIndex(dam.block_size, data_offset, partitions, groups)
+
+
+def _pack_name(name: str) -> bytes:
+    name = name.encode('utf-8')
+    return struct.pack('<H', len(name)) + name
+
+
+def pack_index(index: PayloadIndex) -> bytes:
+    out = [_header.pack(INDEX_MAGIC, index.block_size, index.data_offset, len(index.partitions), len(index.groups))]
+    for name, size, names in index.groups:
+        name = name.encode('utf-8')
+        out.append(_group.pack(len(name), size, len(names)))
+        out.append(name)
+        out.extend(_pack_name(i) for i in names)
+    for part in index.partitions:
+        name = part.name.encode('utf-8')
+        out.append(_partition.pack(len(name), part.size, len(part.hash), len(part.operations)))
+        out.append(name)
+        out.append(part.hash)
+        for op in part.operations:
+            out.append(_op.pack(op.type, op.data_offset, op.data_length, len(op.data_sha256_hash),
+                                len(op.src_extents), len(op.dst_extents)))
+            out.append(op.data_sha256_hash)
+            extents = op.src_extents + op.dst_extents
+            out.append(struct.pack(f'<{len(extents) * 2}Q', *(i for ext in extents for i in ext)))
+    return b''.join(out)
+
+
+def unpack_index(data: bytes) -> PayloadIndex:
+    magic, block_size, data_offset, count, group_count = _header.unpack_from(data)
+    if magic != INDEX_MAGIC:
+        raise ValueError("Not a payload index")
+    pos = _header.size
+    groups = []
+    for _ in range(group_count):
+        name_length, size, name_count = _group.unpack_from(data, pos)
+        pos += _group.size
+        name = data[pos:pos + name_length].decode('utf-8')
+        pos += name_length
+        names = []
+        for _ in range(name_count):
+            length, = struct.unpack_from('<H', data, pos)
+            names.append(data[pos + 2:pos + 2 + length].decode('utf-8'))
+            pos += 2 + length
+        groups.append((name, size, names))
+    partitions = []
+    for _ in range(count):
+        name_length, size, hash_length, op_count = _partition.unpack_from(data, pos)
+        pos += _partition.size
+        name = data[pos:pos + name_length].decode('utf-8')
+        pos += name_length
+        part_hash = data[pos:pos + hash_length]
+        pos += hash_length
+        operations = []
+        for _ in range(op_count):
+            op_type, op_offset, op_length, hash_length, src_count, dst_count = _op.unpack_from(data, pos)
+            pos += _op.size
+            op_hash = data[pos:pos + hash_length]
+            pos += hash_length
+            values = struct.unpack_from(f'<{(src_count + dst_count) * 2}Q', data, pos)
+            pos += (src_count + dst_count) * 16
+            extents = tuple(zip(values[::2], values[1::2]))
+            operations.append(OpDescriptor(op_offset, op_length, extents[src_count:], op_type, extents[:src_count],
+                                           op_hash))
+        partitions.append(PartitionEntry(name, size, part_hash, operations))
+    if pos != len(data):
+        raise ValueError("Payload index has trailing data")
+    return PayloadIndex(block_size, data_offset, partitions, groups)
+
+
+def load_index(path: str, offset: int = 0, cache_dir: str = None, payloadfile=None) -> PayloadIndex:
+    """
+    Return the index of the payload at offset in path.
+    :param path: payload.bin or the OTA zip storing it
+    :param offset: start of the payload inside path
+    :param cache_dir: indexes are cached here, None disables the cache
+    :param payloadfile: opened handle of path to parse from on a cache miss
+    """
+    cache_file = None
+    if cache_dir:
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}|{offset}|{stat.st_size}|{stat.st_mtime_ns}"
+        cache_file = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.idx')
+        try:
+            with open(cache_file, 'rb') as f:
+                return unpack_index(f.read())
+        except (OSError, ValueError, struct.error):
+            pass
+    if payloadfile is None:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            index = read_index(f)
+    else:
+        payloadfile.seek(offset)
+        index = read_index(payloadfile)
+    if cache_file:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(f'{cache_file}.{os.getpid()}', 'wb') as f:
+                f.write(pack_index(index))
+            os.replace(f'{cache_file}.{os.getpid()}', cache_file)
+        except OSError:
+            pass
+    return index
@@ -0,0 +1,212 @@
+# Copyright (C) 2022-2025 The MIO-KITCHEN-SOURCE Project
+#
+# Licensed under the GNU AFFERO GENERAL PUBLIC LICENSE, Version 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.gnu.org/licenses/agpl-3.0.en.html#license-text
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Write full OTA payload.bin files.
+Every image is split into fixed-size operations, compressed on a process pool with every enabled method,
+and the smallest result is kept. Room for the manifest is reserved at its largest possible size, the data blob is
+streamed right behind it while the operations come back, then the manifest is written into the room, padded to fill
+it. The payload is not signed.
+"""
+import bz2
+import hashlib
+import lzma
+import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+import zstandard
+
+from . import update_metadata_pb2 as um
+
+Op = um.InstallOperation
+# Size of one operation, as in delta_generator full payloads.
+OP_SIZE = 2097152
+COMPRESSORS = {
+    'xz': (Op.REPLACE_XZ, lambda data: lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32)),
+    'zstd': (Op.REPLACE_ZSTD, lambda data: zstandard.ZstdCompressor(level=9).compress(data)),
+    'bz2': (Op.REPLACE_BZ, lambda data: bz2.compress(data, 9)),
+}
+# Unknown manifest field the padding is stored in, readers skip it
+PADDING_FIELD = 1000
+HEADER_SIZE = 24
+
+
+def compress_chunk(path, offset, length, methods):
+    """
+    Build the data of one operation, runs in a worker process.
+    :return: (type, data), data is b'' for ZERO operations
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    if len(data) != length:
+        raise EOFError(f"{path} is shorter than expected")
+    if not data.strip(b'\0'):
+        return Op.ZERO, b''
+    best_type, best = Op.REPLACE, data
+    for method in methods:
+        op_type, compress = COMPRESSORS[method]
+        compressed = compress(data)
+        if len(compressed) < len(best):
+            best_type, best = op_type, compressed
+    return best_type, best
+
+
+def varint(value, width=0):
+    """
+    Protobuf varint of value, stretched to width bytes with continuation bytes.
+    """
+    out = bytearray()
+    while True:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+        if not value and len(out) >= width:
+            break
+    out[-1] &= 0x7F
+    return bytes(out)
+
+
+def pad_manifest(manifest, size) -> bytes:
+    """
+    Serialize manifest to exactly size bytes. Gaps are filled with an unknown bytes field, gaps too small for one
+    by writing block_size as a longer varint.
+    """
+    data = manifest.SerializeToString()
+    gap = size - len(data)
+    if gap < 0:
+        raise ValueError("Manifest is larger than its reserved size")
+    if gap >= 6:
+        # 2 bytes of tag and the length as a 4 byte varint
+        return data + varint(PADDING_FIELD << 3 | 2) + varint(gap - 6, 4) + bytes(gap - 6)
+    if gap:
+        rest = um.DeltaArchiveManifest()
+        rest.CopyFrom(manifest)
+        rest.ClearField('block_size')
+        return varint(3 << 3) + varint(manifest.block_size, len(varint(manifest.block_size)) + gap) + \
+            rest.SerializeToString()
+    return data
+
+
+class PayloadWriter:
+    """
+    :param images: list of (partition name, raw image path), the images must be block aligned
+    :param groups: dynamic partition groups as (name, size, [partition names]), empty for non dynamic devices
+    :param virtual_ab: set snapshot_enabled in the dynamic partition metadata
+    """
+
+    def __init__(self, images, block_size=4096, op_size=OP_SIZE, methods=('xz', 'zstd', 'bz2'),
+                 workers=cpu_count(), groups=(), virtual_ab=False):
+        self.images = images
+        self.block_size = block_size
+        self.op_size = op_size - op_size % block_size
+        self.methods = [i for i in methods if i in COMPRESSORS]
+        self.workers = workers
+        self.groups = groups
+        self.virtual_ab = virtual_ab
+
+    def chunks(self):
+        for name, path in self.images:
+            size = os.path.getsize(path)
+            if size % self.block_size:
+                raise ValueError(f"{path} size is not a multiple of {self.block_size}")
+            for offset in range(0, size, self.op_size):
+                yield name, path, offset, min(self.op_size, size - offset)
+
+    def write(self, out):
+        """
+        Write the payload to out.
+        """
+        manifest = um.DeltaArchiveManifest()
+        manifest.block_size = self.block_size
+        manifest.minor_version = 0
+        partitions = {}
+        for name, path in self.images:
+            part = manifest.partitions.add()
+            part.partition_name = name
+            part.new_partition_info.size = os.path.getsize(path)
+            part.new_partition_info.hash = bytes(32)
+            partitions[name] = part
+        if self.groups:
+            metadata = manifest.dynamic_partition_metadata
+            metadata.snapshot_enabled = self.virtual_ab
+            for name, size, names in self.groups:
+                group = metadata.groups.add()
+                group.name = name
+                group.size = size
+                group.partition_names.extend(names)
+
+        # Every operation starts at its largest encoding: data no longer than the chunk at the end of a blob
+        # as long as all images, so the manifest found after compression always fits in the reserved room.
+        total = sum(part.new_partition_info.size for part in partitions.values())
+        chunks = []
+        for name, path, offset, length in self.chunks():
+            op = partitions[name].operations.add()
+            op.type = Op.REPLACE
+            op.data_offset = total
+            op.data_length = length
+            op.data_sha256_hash = bytes(32)
+            extent = op.dst_extents.add()
+            extent.start_block = offset // self.block_size
+            extent.num_blocks = length // self.block_size
+            chunks.append((name, path, offset, length, op))
+        manifest_size = manifest.ByteSize()
+        digests = {name: hashlib.sha256() for name in partitions}
+        data_offset = 0
+        try:
+            with open(out, 'wb') as f, ProcessPoolExecutor(max_workers=self.workers) as executor:
+                f.seek(HEADER_SIZE + manifest_size)
+                # Keep a bounded window of chunks in flight, results are consumed in order.
+                pending = deque()
+                chunks = iter(chunks)
+                while True:
+                    for name, path, offset, length, op in chunks:
+                        pending.append((name, path, offset, length, op,
+                                        executor.submit(compress_chunk, path, offset, length, self.methods)))
+                        if len(pending) >= self.workers * 4:
+                            break
+                    if not pending:
+                        break
+                    name, path, offset, length, op, future = pending.popleft()
+                    op.type, data = future.result()
+                    # The partition hash is built here in order, the chunk is only read again when it was compressed
+                    if op.type == Op.ZERO:
+                        digests[name].update(bytes(length))
+                    elif op.type == Op.REPLACE:
+                        digests[name].update(data)
+                    else:
+                        with open(path, 'rb') as image:
+                            image.seek(offset)
+                            digests[name].update(image.read(length))
+                    if data:
+                        op.data_offset = data_offset
+                        op.data_length = len(data)
+                        op.data_sha256_hash = hashlib.sha256(data).digest()
+                        f.write(data)
+                        data_offset += len(data)
+                    else:
+                        op.ClearField('data_offset')
+                        op.ClearField('data_length')
+                        op.ClearField('data_sha256_hash')
+                for name, part in partitions.items():
+                    part.new_partition_info.hash = digests[name].digest()
+                f.seek(0)
+                f.write(b'CrAU' + struct.pack('>QQI', 2, manifest_size, 0))
+                f.write(pad_manifest(manifest, manifest_size))
+        except BaseException:
+            if os.path.exists(out):
+                os.remove(out)
+            raise
+        return manifest
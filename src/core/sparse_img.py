@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import os
 import struct
 import sys
@@ -20,6 +21,110 @@ from bisect import bisect_right
 from . import rangelib
 
 
+class SparseWriter:
+    """Writes an Android sparse image as a seekable, write-only file.
+
+  The expanded image must be written in increasing offset order. Skipped
+  ranges become DONT_CARE chunks, fill() adds FILL chunks and written data
+  goes to RAW chunks. Adjacent chunks of the same kind are merged. The file
+  header is written by close().
+  """
+
+    def __init__(self, f, blocksize, total_blocks):
+        self.f = f
+        self.blocksize = blocksize
+        self.total_blocks = total_blocks
+        self.total_chunks = 0
+        self.pos = 0  # in bytes of the expanded image
+        # Open chunk: [type, blocks, header offset (raw) or fill data (fill)]
+        self.chunk = None
+        self.raw_len = 0
+        f.write(bytes(28))
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence != os.SEEK_SET:
+            raise ValueError("SparseWriter only supports SEEK_SET and SEEK_CUR")
+        if offset < self.pos:
+            raise ValueError(f"Cannot seek back to {offset:d}, sparse output is written in order")
+        if offset > self.pos:
+            if offset % self.blocksize or self.raw_len % self.blocksize:
+                raise ValueError("Sparse output can only skip whole blocks")
+            self._add(0xCAC3, (offset - self.pos) // self.blocksize)
+            self.pos = offset
+        return self.pos
+
+    def write(self, data):
+        if self.chunk is None or self.chunk[0] != 0xCAC1:
+            self._close_chunk()
+            self.chunk = [0xCAC1, 0, self.f.tell()]
+            self.raw_len = 0
+            self.f.write(bytes(12))
+        self.f.write(data)
+        self.raw_len += len(data)
+        self.pos += len(data)
+        return len(data)
+
+    def fill(self, length, fill_data=b"\0\0\0\0"):
+        if length % self.blocksize or self.pos % self.blocksize:
+            raise ValueError("Fill chunks must cover whole blocks")
+        self._add(0xCAC2, length // self.blocksize, fill_data)
+        self.pos += length
+
+    def _add(self, chunk_type, blocks, fill_data=None):
+        if self.chunk is not None and self.chunk[0] == chunk_type and (
+                chunk_type == 0xCAC3 or self.chunk[2] == fill_data):
+            self.chunk[1] += blocks
+            return
+        self._close_chunk()
+        self.chunk = [chunk_type, blocks, fill_data]
+
+    def _close_chunk(self):
+        if self.chunk is None:
+            return
+        chunk_type, blocks, extra = self.chunk
+        self.chunk = None
+        self.total_chunks += 1
+        if chunk_type == 0xCAC1:
+            if self.raw_len % self.blocksize:
+                pad = self.blocksize - self.raw_len % self.blocksize
+                self.f.write(bytes(pad))
+                self.raw_len += pad
+                self.pos += pad
+            end = self.f.tell()
+            self.f.seek(extra, os.SEEK_SET)
+            self.f.write(struct.pack("<2H2I", chunk_type, 0, self.raw_len // self.blocksize, 12 + self.raw_len))
+            self.f.seek(end, os.SEEK_SET)
+        elif chunk_type == 0xCAC2:
+            self.f.write(struct.pack("<2H2I", chunk_type, 0, blocks, 16) + extra)
+        else:
+            self.f.write(struct.pack("<2H2I", chunk_type, 0, blocks, 12))
+
+    def close(self):
+        """Pad the image to total_blocks and write the file header."""
+        end = self.total_blocks * self.blocksize
+        self._close_chunk()
+        if self.pos < end:
+            self.seek(end)
+            self._close_chunk()
+        if self.pos > end:
+            raise ValueError(f"Sparse image holds {self.pos:d} bytes, more than its {end:d} bytes")
+        self.f.seek(0, os.SEEK_SET)
+        self.f.write(struct.pack("<I4H4I", 0xED26FF3A, 1, 0, 28, 12, self.blocksize, self.total_blocks,
+                                 self.total_chunks, 0))
+        self.f.seek(0, os.SEEK_END)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class SparseImage:
     """Wraps a sparse image file into an image object.
 
@@ -247,3 +352,77 @@ class SparseImage:
                 out[f"__NONZERO-{i:d}"] = rangelib.RangeSet(data=blocks)
         if clobbered_blocks:
             out["__COPY"] = clobbered_blocks
+
+
+class SparseImageFile(io.RawIOBase):
+    """
+    Read-only, seekable file over the raw image stored in a sparse image, built on the chunk table of
+    SparseImage. Nothing is converted on disk: RAW chunks are read in place, FILL chunks repeat their
+    pattern and DONT_CARE gaps read as zeros.
+    :param image: already parsed SparseImage of simg_fn to share, the file then gets its own handle
+    """
+
+    def __init__(self, simg_fn, image=None):
+        super().__init__()
+        self.image = image if image is not None else SparseImage(simg_fn)
+        self.file = open(simg_fn, 'rb') if image is not None else self.image.simg_f
+        self.size = self.image.total_blocks * self.image.blocksize
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset:d}")
+        self.pos = offset
+        return offset
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        image = self.image
+        blocksize = image.blocksize
+        pos = self.pos
+        end = min(pos + len(view), self.size)
+        done = 0
+        while pos < end:
+            idx = bisect_right(image.offset_index, pos // blocksize) - 1
+            chunk_start, chunk_len, filepos, fill_data = image.offset_map[idx] if idx >= 0 else (0, 0, None, None)
+            chunk_start *= blocksize
+            chunk_end = chunk_start + chunk_len * blocksize
+            if pos >= chunk_end:
+                # DONT_CARE up to the next chunk
+                next_start = image.offset_map[idx + 1][0] * blocksize if idx + 1 < len(image.offset_map) else end
+                length = min(end, next_start) - pos
+                view[done:done + length] = bytes(length)
+            else:
+                length = min(end, chunk_end) - pos
+                if filepos is None:
+                    # Chunks start on a block boundary, so the pattern is aligned to the chunk
+                    skip = (pos - chunk_start) % 4
+                    view[done:done + length] = (fill_data * ((skip + length) // 4 + 1))[skip:skip + length]
+                else:
+                    self.file.seek(filepos + pos - chunk_start)
+                    got = self.file.readinto(view[done:done + length])
+                    if got != length:
+                        done += got
+                        break
+            pos += length
+            done += length
+        self.pos += done
+        return done
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
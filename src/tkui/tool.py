@@ -21,7 +21,7 @@ import re
 import shutil
 import subprocess
 import threading
-from functools import wraps
+from functools import partial, wraps
 from random import randrange
 from tkinter.ttk import Scrollbar
 from src.core.avb_disabler import process_fstab
@@ -65,6 +65,9 @@ import sv_ttk
 from PIL.Image import open as open_img
 from PIL.ImageTk import PhotoImage
 from src.core.dumper import Dumper
+from src.core.ext4_builder import Ext4Builder
+from src.core.payload_index import load_index, zip_member_offset
+from src.core.payload_writer import PayloadWriter
 from src.core.utils import lang, LogoDumper, terminate_process, calculate_md5_file, calculate_sha256_file, \
     JsonEdit, DevNull, ModuleErrorCodes, hum_convert, GuoKeLogo, img2simg
 
@@ -75,6 +78,7 @@ else:
     from src.core import mkc_filedialog as filedialog
 
 from src.core import imgextractor
+from src.core.sparse_img import SparseImageFile
 from src.core import lpunpack
 from src.core import mkdtboimg
 from src.core import ozipdecrypt
@@ -4884,7 +4888,7 @@ class PackHybridRom:
 class PackPayload(Toplevel):
     def __init__(self):
         super().__init__()
-        self.title("打包Payload")
+        self.title(lang.pack_payload)
         self.overhead = 4194304
         # multi group_size must 4194304 less than super
         self.super_size = IntVar(value=17179869184)
@@ -4892,8 +4896,10 @@ class PackPayload(Toplevel):
         self.group_name = StringVar(value="qti_dynamic_partitions")
         self.virtual_ab = BooleanVar(value=True)
         self.part_list = []
+        self.work = project_manger.current_work_path()
         self.gui()
         move_center(self)
+        create_thread(self.refresh)
 
     def gui(self):
         """Group Name"""
@@ -4918,6 +4924,39 @@ class PackPayload(Toplevel):
         group_size_entry = ttk.Entry(group_size_frame, textvariable=self.group_size)
         group_size_entry.pack(padx=5, pady=5, fill='both')
         group_size_frame.pack(padx=5, pady=5, fill=BOTH)
+        ttk.Checkbutton(self, text="Virtual-ab", variable=self.virtual_ab, onvalue=True, offvalue=False,
+                        style="Switch.TCheckbutton").pack(padx=10, pady=10, fill=BOTH)
+        """Partitions"""
+        (lf := ttk.LabelFrame(self, text=lang.text55)).pack(fill=BOTH, expand=True)
+        self.tl = ListBox(lf)
+        self.tl.gui()
+        self.tl.pack(padx=10, pady=10, expand=True, fill=BOTH)
+        ttk.Button(self, text=lang.cancel, command=self.destroy).pack(side='left', padx=10, pady=10, fill=X,
+                                                                      expand=True)
+        ttk.Button(self, text=lang.pack, command=lambda: create_thread(self.start_), style="Accent.TButton").pack(
+            side='left', padx=5, pady=5, fill=X, expand=True)
+
+    def refresh(self):
+        self.tl.clear()
+        for file_name in sorted(os.listdir(self.work)):
+            if file_name.endswith(".img") and file_name != 'super.img':
+                file_type = gettype(self.work + file_name)
+                name = file_name[:-4]
+                self.tl.insert(f"{name} [{file_type}]", name, file_type in ["ext", "erofs", 'f2fs', 'sparse'])
+
+    def start_(self):
+        part_list = self.tl.selected.copy()
+        try:
+            group_size = self.group_size.get()
+        except (Exception, BaseException):
+            logging.exception('Bugs')
+            group_size = 0
+        self.destroy()
+        if not project_manger.exist():
+            warn_win(text=lang.warn1)
+            return False
+        pack_payload(part_list, self.group_name.get(), group_size, self.virtual_ab.get())
+        return None
 
 
 class PackSuper(Toplevel):
@@ -4931,6 +4970,9 @@ class PackSuper(Toplevel):
         self.group_name = StringVar()
         self.delete_source_file = IntVar()
         self.block_device_name = StringVar(value='super')
+        # Build super straight from the dynamic partitions of the project payload
+        self.from_payload = BooleanVar()
+        self.payload_sizes = {}
         self.selected = []
         (lf1 := ttk.LabelFrame(self, text=lang.text54)).pack(fill=BOTH)
         (lf1_r := ttk.LabelFrame(self, text=lang.attribute)).pack(fill=BOTH)
@@ -4967,6 +5009,10 @@ class PackSuper(Toplevel):
         ttk.Checkbutton(self, text=lang.text58, variable=self.is_sparse, onvalue=True, offvalue=False,
                         style="Switch.TCheckbutton").pack(
             padx=10, pady=10, fill=BOTH)
+        if payload_source(self.work)[0]:
+            ttk.Checkbutton(self, text=lang.super_from_payload, variable=self.from_payload, onvalue=True,
+                            offvalue=False, style="Switch.TCheckbutton",
+                            command=lambda: create_thread(self.refresh)).pack(padx=10, pady=10, fill=BOTH)
         t_frame = Frame(self)
         ttk.Checkbutton(t_frame, text=lang.t11, variable=self.delete_source_file, onvalue=1, offvalue=0,
                         style="Switch.TCheckbutton").pack(side=LEFT,
@@ -5003,6 +5049,11 @@ class PackSuper(Toplevel):
         if not project_manger.exist():
             warn_win(text=lang.warn1)
             return False
+        if self.from_payload.get():
+            pack_super_payload(sparse=self.is_sparse.get(), group_name=self.group_name.get(),
+                               size=self.super_size.get(), super_type=self.super_type.get(), part_list=lbs,
+                               attrib=self.attrib.get(), block_device_name=self.block_device_name.get())
+            return None
         pack_super(sparse=self.is_sparse.get(), group_name=self.group_name.get(), size=self.super_size.get(),
                    super_type=self.super_type.get(),
                    part_list=lbs, del_=sc,
@@ -5010,7 +5061,10 @@ class PackSuper(Toplevel):
         return None
 
     def verify_size(self):
-        size = sum([os.path.getsize(f"{self.work}/{i}.img") for i in self.tl.selected])
+        if self.from_payload.get():
+            size = sum([self.payload_sizes[i] for i in self.tl.selected])
+        else:
+            size = sum([os.path.getsize(f"{self.work}/{i}.img") for i in self.tl.selected])
         diff_size = size
         if size > self.super_size.get():
             for i in range(20):
@@ -5044,6 +5098,18 @@ class PackSuper(Toplevel):
 
     def refresh(self):
         self.tl.clear()
+        if self.from_payload.get():
+            payload_file, member = payload_source(self.work)
+            if not payload_file:
+                return
+            with open(payload_file, 'rb') as pay:
+                index = load_index(payload_file, zip_member_offset(pay, member) if member else 0,
+                                   f'{temp}/payload_index', pay)
+            dynamic = {name for _, _, names in index.groups for name in names}
+            self.payload_sizes = {i.name: i.size for i in index.partitions if i.name in dynamic}
+            for name, size in self.payload_sizes.items():
+                self.tl.insert(f"{name} [payload]{hum_convert(size):>10}", name, name in self.selected)
+            return
         for file_name in os.listdir(self.work):
             if file_name.endswith(".img"):
                 if (file_type := gettype(self.work + file_name)) in ["ext", "erofs", 'f2fs', 'sparse']:
@@ -5110,6 +5176,63 @@ class PackSuper(Toplevel):
 
 
 @animation
+def pack_super_payload(sparse: bool, group_name: str, size: int, super_type, part_list: list, attrib='readonly',
+                       output_dir: str = None, work: str = None, block_device_name: str = 'super'):
+    """
+    Build super.img straight from the payload of the project, without writing partition images first
+    :param part_list: partitions of the payload dynamic partition groups
+    """
+    if not work:
+        work = project_manger.current_work_path()
+    if not output_dir:
+        output_dir = project_manger.current_work_output_path()
+    payload_file, member = payload_source(work)
+    if not payload_file or not part_list:
+        return False
+    dumper = Dumper(payload_file, output_dir, images=part_list, member=member, index_dir=f'{temp}/payload_index')
+    try:
+        layout = dumper.super_layout(group_name, size, super_type, attrib, block_device_name or 'super')
+        dumper.dump_super(f'{output_dir}/super.img', layout, sparse)
+    except ValueError as e:
+        logging.exception('pack_super_payload')
+        win.message_pop(str(e))
+        return False
+    print(lang.text59 % (output_dir + "super.img"))
+    return True
+
+
+@animation
+def pack_payload(part_list: list, group_name: str, group_size: int, virtual_ab: bool, output_dir: str = None,
+                 work: str = None):
+    """
+    Pack images of the project into a full OTA payload.bin
+    :param part_list: partitions to pack, filesystem images go to the dynamic partition group
+    """
+    if not work:
+        work = project_manger.current_work_path()
+    if not output_dir:
+        output_dir = project_manger.current_work_output_path()
+    images = []
+    dynamic = []
+    for part in part_list:
+        if gettype(f"{work}/{part}.img") == 'sparse':
+            utils.simg2img(f"{work}/{part}.img")
+        if gettype(f"{work}/{part}.img") in ["ext", "erofs", 'f2fs']:
+            dynamic.append(part)
+        images.append((part, f"{work}/{part}.img"))
+    if not images:
+        return False
+    groups = [(group_name, group_size, dynamic)] if dynamic and group_name else []
+    try:
+        PayloadWriter(images, groups=groups, virtual_ab=virtual_ab).write(f'{output_dir}/payload.bin')
+    except (Exception, BaseException):
+        logging.exception('PackPayload')
+        win.message_pop(lang.warn10)
+        return False
+    print(lang.text59 % f'{output_dir}/payload.bin')
+    return True
+
+
 def pack_super(sparse: bool, group_name: str, size: int, super_type, part_list: list, del_=0, return_cmd=0,
                attrib='readonly',
                output_dir: str = None, work: str = None, block_device_name: str = 'None'):
@@ -5450,7 +5573,8 @@ class Packxx(Toplevel):
         (sf1 := Frame(lf3)).pack(fill=X, padx=5, pady=5, side=TOP)
         # EXT4 Settings
         Label(lf1, text=lang.text48).pack(side='left', padx=5, pady=5)
-        ttk.Combobox(lf1, state="readonly", values=("make_ext4fs", "mke2fs+e2fsdroid"), textvariable=self.dbfs).pack(
+        ttk.Combobox(lf1, state="readonly", values=("make_ext4fs", "mke2fs+e2fsdroid", "ext4_builder"),
+                     textvariable=self.dbfs).pack(
             side='left', padx=5, pady=5)
         Label(lf1, text=lang.t31).pack(side='left', padx=5, pady=5)
         ttk.Combobox(lf1, state="readonly", values=(lang.t32, lang.t33), textvariable=self.ext4_method).pack(
@@ -5701,7 +5825,11 @@ class Packxx(Toplevel):
                                                 work_output=project_manger.current_work_output_path(),
                                                 sparse=self.dbgs.get() in ["dat", "br", "sparse"], size=ext4_size_value,
                                                 UTC=self.UTC.get(), has_contexts=os.path.exists(contexts_file))
-
+                    elif self.dbfs.get() == "ext4_builder":
+                        exit_code = make_ext4_native(name=dname, work=work,
+                                                     work_output=project_manger.current_work_output_path(),
+                                                     sparse=self.dbgs.get() in ["dat", "br", "sparse"],
+                                                     size=ext4_size_value, UTC=self.UTC.get())
                     else:
                         exit_code = mke2fs(
                             name=dname, work=work,
@@ -5748,7 +5876,7 @@ def rdi(work, part_name) -> bool:
         print(lang.text72 % part_name)
         try:
             rmdir(work + part_name)
-            for i_ in ["%s_size.txt", "%s_file_contexts", '%s_fs_config', '%s_fs_options']:
+            for i_ in ["%s_size.txt", "%s_file_contexts", '%s_fs_config', '%s_fs_options', '%s_hardlinks.txt']:
                 path_ = os.path.join(work, "config", i_ % part_name)
                 if os.access(path_, os.F_OK):
                     os.remove(path_)
@@ -5884,6 +6012,11 @@ def unpackrom(ifile) -> None:
         current_project_name.set(os.path.splitext(os.path.basename(ifile))[0])
         with zipfile.ZipFile(ifile, 'r') as fz:
             for fi in fz.namelist():
+                if fi == 'payload.bin' and fz.getinfo(fi).compress_type == zipfile.ZIP_STORED:
+                    # Stored payloads are dumped straight from the zip, see payload_source.
+                    JsonEdit(os.path.join(project_manger.current_work_path(), 'config', 'parts_info')).edit(
+                        'payload_zip', [os.path.abspath(ifile), fi])
+                    continue
                 try:
                     member_name = fi.encode('cp437').decode('gbk')
                 except (Exception, BaseException):
@@ -5988,6 +6121,55 @@ class ProjectManager:
 project_manger = ProjectManager()
 
 
+def payload_source(work: str):
+    """
+    Find the payload of a project
+    :param work: project path
+    :return: (file, member), member is None if payload.bin is extracted, (None, None) if no payload found
+    """
+    if os.path.exists(f"{work}/payload.bin"):
+        return f"{work}/payload.bin", None
+    source = JsonEdit(f"{work}/config/parts_info").read().get('payload_zip')
+    if source:
+        if os.path.isfile(source[0]):
+            return source[0], source[1]
+        # Only the path of the zip is kept in the project
+        print(f"[E] {lang.payload_zip_missing.format(source[0])}")
+        win.message_pop(lang.payload_zip_missing.format(source[0]))
+    return None, None
+
+
+def unpack_super_ext4(super_image: str, work: str, parts: dict, names: list = None) -> list:
+    """
+    Extract the ext4 partitions of super straight into project folders, no partition image is written
+    :param names: partitions to look at, all of them when None
+    :return: names of the extracted partitions
+    """
+    extracted = []
+    partitions = lpunpack.get_extents(super_image)
+    for name, extents in partitions.items():
+        if names and name not in names or not extents:
+            continue
+        out_name = name[:-2] if name.endswith('_a') and name[:-2] not in partitions else name
+        opener = partial(lpunpack.open_partition, super_image, name, extents)
+        with opener() as f:
+            f.seek(0x438)
+            if f.read(2) != b'\x53\xef':
+                continue
+            mount = ext4.Volume(f).get_mount_point
+        print(lang.text79 + f"{name} [super -> ext]")
+        if mount[:1] == '/':
+            mount = mount[1:]
+        if '/' in mount:
+            mount = mount.split('/')[-1]
+        if mount != out_name and mount and out_name != 'mi_ext':
+            parts[mount] = 'ext'
+        parts[out_name] = 'ext'
+        imgextractor.Extractor().main(f'{work}/{out_name}.img', f'{work}/{out_name}', work, opener=opener)
+        extracted.append(name)
+    return extracted
+
+
 @animation
 def unpack(chose, form: str = '') -> bool:
     if os.name == 'nt':
@@ -6008,7 +6190,11 @@ def unpack(chose, form: str = '') -> bool:
         return False
     if form == 'payload':
         print(lang.text79 + "payload")
-        dumper = Dumper(f"{work}/payload.bin", work, diff=False, old='old', images=chose)
+        payload_file, member = payload_source(work)
+        if not payload_file:
+            return False
+        dumper = Dumper(payload_file, work, diff=False, old='old', images=chose, split_ops=True, member=member,
+                        index_dir=f'{temp}/payload_index')
         try:
             dumper.run()
         except RuntimeError:
@@ -6026,7 +6212,12 @@ def unpack(chose, form: str = '') -> bool:
         if gettype(f"{work}/super.img") == 'super':
             # should get info here.
             parts["super_info"] = lpunpack.get_info(os.path.join(work, "super.img"))
-            lpunpack.unpack(os.path.join(work, "super.img"), work, chose)
+            names = chose
+            if settings.auto_unpack == '1':
+                extracted = unpack_super_ext4(os.path.join(work, "super.img"), work, parts, chose)
+                names = [i for i in chose if i not in extracted]
+            if names:
+                lpunpack.unpack(os.path.join(work, "super.img"), work, names)
             for file_name in os.listdir(work):
                 if file_name.endswith('_a.img') and not os.path.exists(work + file_name.replace('_a', '')):
                     os.rename(work + file_name, work + file_name.replace('_a', ''))
@@ -6097,18 +6288,27 @@ def unpack(chose, form: str = '') -> bool:
                 print(f"{lang.text85}AVB:{i}")
                 utils.Vbpatch(f"{work}/{i}.img").disavb()
             file_type = gettype(f"{work}/{i}.img")
-            if file_type == "sparse":
+            # Sparse ext4 images are extracted in place, without converting them first
+            sparse_ext = file_type == "sparse" and imgextractor.sparse_ext4(f"{work}/{i}.img")
+            if file_type == "sparse" and not sparse_ext:
                 print(lang.text79 + f"{i}.img[{file_type}]")
                 try:
                     utils.simg2img(f"{work}/{i}.img")
                 except (Exception, BaseException):
                     win.message_pop(lang.warn11.format(f"{i}.img"))
             if i not in parts.keys():
-                parts[i] = gettype(f"{work}/{i}.img")
+                parts[i] = 'ext' if sparse_ext else gettype(f"{work}/{i}.img")
             print(lang.text79 + i + f".img[{file_type}]")
             if gettype(f"{work}/{i}.img") == 'super':
                 parts["super_info"] = lpunpack.get_info(f"{work}/{i}.img")
-                lpunpack.unpack(f"{work}/{i}.img", work)
+                if settings.auto_unpack == '1':
+                    # ext4 partitions go straight into folders, the others are still written out as images
+                    extracted = unpack_super_ext4(f"{work}/{i}.img", work, parts)
+                    names = [name for name in lpunpack.get_parts(f"{work}/{i}.img") if name not in extracted]
+                    if names:
+                        lpunpack.unpack(f"{work}/{i}.img", work, names)
+                else:
+                    lpunpack.unpack(f"{work}/{i}.img", work)
                 for file_name in os.listdir(work):
                     if file_name.endswith('_a.img'):
                         if os.path.exists(work + file_name) and os.path.exists(work + file_name.replace('_a', '')):
@@ -6124,8 +6324,8 @@ def unpack(chose, form: str = '') -> bool:
                             os.remove(work + file_name)
                 json_.write(parts)
                 parts.clear()
-            if (file_type := gettype(f"{work}/{i}.img")) == "ext":
-                with open(f"{work}/{i}.img", 'rb+') as e:
+            if (file_type := gettype(f"{work}/{i}.img")) == "ext" or sparse_ext:
+                with (SparseImageFile(f"{work}/{i}.img") if sparse_ext else open(f"{work}/{i}.img", 'rb+')) as e:
                     mount = ext4.Volume(e).get_mount_point
                     if mount[:1] == '/':
                         mount = mount[1:]
@@ -6134,7 +6334,8 @@ def unpack(chose, form: str = '') -> bool:
                         mount = mount[len(mount) - 1]
                     if mount != i and mount and i != 'mi_ext':
                         parts[mount] = 'ext'
-                imgextractor.Extractor().main(project_manger.current_work_path() + i + ".img", f'{work}/{i}', work)
+                imgextractor.Extractor().main(project_manger.current_work_path() + i + ".img", f'{work}/{i}', work,
+                                              target_type='s_img' if sparse_ext else 'img')
                 if os.path.exists(f'{work}/{i}'):
                     try:
                         os.remove(f"{work}/{i}.img")
@@ -6368,6 +6569,22 @@ def make_ext4fs(name: str, work: str, work_output, sparse: bool = False, size: i
     return call(command)
 
 
+@animation
+def make_ext4_native(name: str, work: str, work_output: str, sparse: bool = False, size: int = 0, UTC: int = None):
+    print(lang.text91 % name)
+    config = f'{work}/config/{name}'
+    try:
+        size = Ext4Builder(work + name, name, f'{config}_fs_config', f'{config}_file_contexts',
+                           hardlinks=f'{config}_hardlinks.txt', timestamp=UTC or None,
+                           size=int(size)).build(f"{work_output}/{name}.img", sparse)
+    except (OSError, ValueError) as e:
+        logging.exception('Ext4Builder')
+        print(f'[E] {e}')
+        return 1
+    print(f"{name}:[{size}]")
+    return 0
+
+
 @animation
 def make_f2fs(name: str, work: str, work_output: str, UTC: int = None):
     print(lang.text91 % name)
@@ -6632,7 +6849,7 @@ class Frame3(ttk.LabelFrame):
             (lang.text123, lambda: create_thread(PackSuper)),
             (lang.text19, lambda: win.notepad.select(win.tab7)),
             (lang.t13, lambda: create_thread(FormatConversion)),
-            # ("打包 Payload", lambda: create_thread(PackPayload)),
+            (lang.pack_payload, lambda: create_thread(PackPayload)),
         ]
         for index, (text, func) in enumerate(functions):
             column = index % 4
@@ -6762,11 +6979,13 @@ class UnpackGui(ttk.LabelFrame):
 
         form = self.fm.get()
         if form == 'payload':
-            if os.path.exists(f"{work}/payload.bin"):
-                with open(f"{work}/payload.bin", 'rb') as pay:
-                    for i in utils.payload_reader(pay).partitions:
-                        self.lsg.insert(f"{i.partition_name}{hum_convert(i.new_partition_info.size):>10}",
-                                        i.partition_name)
+            payload_file, member = payload_source(work)
+            if payload_file:
+                with open(payload_file, 'rb') as pay:
+                    index = load_index(payload_file, zip_member_offset(pay, member) if member else 0,
+                                       f'{temp}/payload_index', pay)
+                for i in index.partitions:
+                    self.lsg.insert(f"{i.name}{hum_convert(i.size):>10}", i.name)
         elif form == 'super':
             if os.path.exists(f"{work}/super.img"):
                 if gettype(f"{work}/super.img") == 'sparse':